@@ -9,6 +9,8 @@ from .query import *
 from .invalidation import *
 from .templatetags.cacheops import *
 from .transaction import install_cacheops_transaction_support
+from .conf import settings
+from .backends import get_backend
 
 
 class CacheopsConfig(AppConfig):
@@ -17,5 +19,7 @@ class CacheopsConfig(AppConfig):
     def ready(self):
         install_cacheops()
         install_cacheops_transaction_support()
+        if settings.CACHEOPS_ENABLED:
+            get_backend().prepare()
 
 default_app_config = 'cacheops.CacheopsConfig'
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from distutils.version import StrictVersion
+import six
+from funcy import memoize
+
+from django.core.signals import setting_changed
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
+
+from .conf import settings
+from .redis import redis_client, handle_connection_failure, load_script, preload_scripts, \
+    prewarm_pools, script_batch, shard_client, all_clients, LOCK_TIMEOUT
+
+
+__all__ = ('BaseBackend', 'ClientBackend', 'RedisBackend', 'MemoryBackend')
+
+
+class BaseBackend(object):
+    """
+    A storage for cached data and its invalidation structures.
+    Key-value methods mirror redis client ones, so that simple cache could use any backend.
+    """
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, data):
+        raise NotImplementedError
+
+    def setex(self, key, timeout, data):
+        raise NotImplementedError
+
+    def set_many(self, mapping, timeout=None):
+        for key, data in mapping.items():
+            if timeout is not None:
+                self.setex(key, timeout, data)
+            else:
+                self.set(key, data)
+
+    def add(self, key, data, timeout):
+        """
+        Sets key only if it's not there yet, returns whether it was set.
+        """
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    @contextmanager
+    def getting(self, prefix, key, lock=False, budget=None):
+        """
+        Yields cached data or None, with lock=True other getters wait till this one caches.
+        """
+        raise NotImplementedError
+
+    def cache_thing(self, prefix, key, data, cond_dnfs, timeout):
+        """
+        Writes pickled data and registers key in invalidators described by cond_dnfs.
+        """
+        raise NotImplementedError
+
+    def invalidate_dict(self, prefix, db_table, obj_dict, scores):
+        """
+        Deletes keys depending on a row of db_table represented by obj_dict.
+        """
+        raise NotImplementedError
+
+    def invalidate_model(self, prefix, db_table):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def prepare(self):
+        """
+        Called on app ready to warm up whatever is needed.
+        """
+
+    @contextmanager
+    def prefetching(self, keys):
+        """
+        Fetches (prefix, key) pairs at once, getting() them within the block won't fetch again.
+        """
+        yield
+
+
+### Redis backend
+
+@memoize
+def redis_can_unlink():
+    info = redis_client.info()
+    # Cluster clients return info for each node
+    infos = [info] if 'redis_version' in info else info.values()
+    return all(StrictVersion(i['redis_version']) >= StrictVersion('4.0') for i in infos)
+
+
+class Prefetched(threading.local):
+    """
+    Data fetched in advance by cache key, each is served once and only in the thread fetched it.
+    """
+    data = None
+
+prefetched = Prefetched()
+
+def _multi_get(client, keys):
+    # Keys could be in different slots, which a single MGET can't fetch in cluster
+    if settings.CACHEOPS_CLUSTER:
+        return client.mget_nonatomic(keys)
+    return client.mget(keys)
+
+
+@handle_connection_failure
+def _mget(client, keys):
+    return _multi_get(client, keys)
+
+
+class ClientBackend(BaseBackend):
+    """
+    Key-value methods over a redis client, RedisCache wraps plain clients with this.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(key)
+
+    @handle_connection_failure
+    def get_many(self, keys):
+        return _multi_get(self.client, keys) if keys else []
+
+    def set_many(self, mapping, timeout=None):
+        pipe = self.client.pipeline(transaction=False)
+        for key, data in mapping.items():
+            if timeout is not None:
+                pipe.setex(key, timeout, data)
+            else:
+                pipe.set(key, data)
+        pipe.execute()
+
+    def set(self, key, data):
+        self.client.set(key, data)
+
+    def setex(self, key, timeout, data):
+        self.client.setex(key, timeout, data)
+
+    @handle_connection_failure
+    def add(self, key, data, timeout):
+        return bool(self.client.set(key, data, ex=timeout, nx=True))
+
+    def delete(self, *keys):
+        self.client.delete(*keys)
+
+    @contextmanager
+    def getting(self, prefix, key, lock=False, budget=None):
+        # Simple cache is deleted directly, not invalidated, so replicas and local cache
+        # could serve it stale, read it from master. Plain redis clients can't lock.
+        if lock and hasattr(self.client, 'getting'):
+            with self.client.getting(key, lock=lock, budget=budget) as data:
+                yield data
+        else:
+            yield self.client.get(key)
+
+
+class RedisBackend(ClientBackend):
+    """
+    Stores everything in redis, updates invalidators atomically with lua scripts.
+    """
+    def __init__(self):
+        super(RedisBackend, self).__init__(redis_client)
+
+    @contextmanager
+    def getting(self, prefix, key, lock=False, budget=None):
+        if prefetched.data and key in prefetched.data:
+            data = prefetched.data.pop(key)
+            # Need to go to redis to lock on miss
+            if data is not None or not lock:
+                yield data
+                return
+        if prefix is None:
+            # Simple cache
+            with super(RedisBackend, self).getting(prefix, key, lock=lock, budget=budget) as data:
+                yield data
+            return
+        with _client(prefix).getting(key, lock=lock, budget=budget) as data:
+            yield data
+
+    @contextmanager
+    def prefetching(self, keys):
+        keys_by_client = defaultdict(list)
+        for prefix, key in keys:
+            keys_by_client[_client(prefix)].append(key)
+
+        data = {}
+        for client, client_keys in keys_by_client.items():
+            values = _mget(client, client_keys)
+            if values is not None:
+                data.update(zip(client_keys, values))
+
+        outer, prefetched.data = prefetched.data, data
+        try:
+            yield
+        finally:
+            prefetched.data = outer
+
+    def cache_thing(self, prefix, key, data, cond_dnfs, timeout):
+        load_script('cache_thing', settings.CACHEOPS_LRU)(
+            keys=[prefix, key],
+            args=[data, json.dumps(cond_dnfs, default=str), timeout],
+            client=shard_client(prefix))
+
+    def invalidate_dict(self, prefix, db_table, obj_dict, scores):
+        client = shard_client(prefix)
+        load_script('invalidate', strip=redis_can_unlink())(keys=[prefix], args=[
+            db_table,
+            json.dumps(obj_dict, default=str),
+            json.dumps(scores),
+        ], client=script_batch.pipeline_for(client))
+        client.forget_local()
+        _forget_prefetched()
+
+    def invalidate_model(self, prefix, db_table):
+        # NOTE: this uses redis KEYS request, which could be relatively slow on large datasets.
+        client = shard_client(prefix)
+        conjs_keys = client.keys('%sconj:%s:*' % (prefix, db_table))
+        range_keys = client.keys('%srange:%s:*' % (prefix, db_table))
+        in_keys = client.keys('%sin:%s:*' % (prefix, db_table))
+        if conjs_keys or range_keys or in_keys:
+            cache_keys = client.sunion(conjs_keys) if conjs_keys else set()
+            for range_key in range_keys:
+                cache_keys.update(entry.split(b':', 1)[1]
+                                  for entry in client.zrange(range_key, 0, -1))
+            # Sets of __in values are bound to cache keys and named after in keys
+            values_keys = []
+            for in_key in in_keys:
+                in_suffix = in_key[len(force_bytes(prefix + 'in:')):]
+                for cache_key in client.smembers(in_key):
+                    cache_keys.add(cache_key)
+                    values_keys.append(cache_key + b':in:' + in_suffix)
+            keys = list(cache_keys) + conjs_keys + range_keys + in_keys + values_keys
+            if redis_can_unlink():
+                client.execute_command('UNLINK', *keys)
+            else:
+                client.delete(*keys)
+        client.forget_local()
+        _forget_prefetched()
+
+    def flush(self):
+        for client in all_clients():
+            client.flushdb()
+            client.forget_local()
+        _forget_prefetched()
+
+    def prepare(self):
+        prewarm_pools()
+        preload_scripts()
+
+
+def _client(prefix):
+    # Keys without prefix are simple cache ones, which are not sharded
+    return redis_client if prefix is None else shard_client(prefix)
+
+def _forget_prefetched():
+    # Prefetched data could be invalidated already
+    if prefetched.data:
+        prefetched.data.clear()
+
+
+### In-memory backend
+
+MISSING = object()
+
+def _lua_str(val):
+    """
+    Normalizes a json value the way lua tostring() does, so that conds match as in redis.
+    """
+    if val is None or val is MISSING:
+        return val
+    elif isinstance(val, bool):
+        return 'true' if val else 'false'
+    elif isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    else:
+        return six.text_type(val)
+
+def _split_special(conj):
+    """
+    Splits conj into eq part and a range [lo, hi] or {"in": [...]} cond, if there is one.
+    """
+    for field, val in conj.items():
+        if isinstance(val, (list, dict)):
+            eq_conj = {f: v for f, v in conj.items() if f != field}
+            return eq_conj, field, val
+    return conj, None, None
+
+
+class MemoryBackend(BaseBackend):
+    """
+    Keeps cache and invalidators in process memory, evicts least recently used keys
+    when there are more than max_entries of them.
+    Invalidation only reaches this process, so use it for tests, development
+    and single process deployments.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._mutex = threading.RLock()
+        self._locks = {}
+        self.flush()
+
+    def flush(self):
+        with self._mutex:
+            self._data = OrderedDict()
+            self._schemes = defaultdict(set)
+            self._rschemes = defaultdict(set)
+            self._ischemes = defaultdict(set)
+            # Invalidators map cache keys to nothing, (lo, hi) ranges or __in value sets
+            self._conjs = defaultdict(dict)
+            self._ranges = defaultdict(dict)
+            self._ins = defaultdict(dict)
+            # Invalidators referencing each cache key to clean them up with it
+            self._refs = defaultdict(set)
+
+    # Key-value
+
+    def get(self, key):
+        with self._mutex:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            data, expires = item
+            if expires is not None and expires <= time.time():
+                self._discard(key)
+                return None
+            # A simple LRU, pop and set moves key to the end
+            self._data[key] = item
+            return data
+
+    def set(self, key, data):
+        self._set(key, data, None)
+
+    def setex(self, key, timeout, data):
+        self._set(key, data, timeout)
+
+    def add(self, key, data, timeout):
+        with self._mutex:
+            if self.get(key) is not None:
+                return False
+            self._set(key, data, timeout)
+            return True
+
+    def delete(self, *keys):
+        with self._mutex:
+            for key in keys:
+                self._discard(key)
+
+    def _set(self, key, data, timeout):
+        with self._mutex:
+            self._discard(key)
+            expires = time.time() + timeout if timeout is not None else None
+            self._data[key] = (data, expires)
+            while len(self._data) > self.max_entries:
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        self._data.pop(key, None)
+        for store_name, index_key in self._refs.pop(key, ()):
+            store = getattr(self, store_name)
+            store[index_key].pop(key, None)
+            if not store[index_key]:
+                del store[index_key]
+
+    def _ref(self, store_name, index_key, key, value=None):
+        getattr(self, store_name)[index_key][key] = value
+        self._refs[key].add((store_name, index_key))
+
+    # Locking
+
+    @contextmanager
+    def getting(self, prefix, key, lock=False, budget=None):
+        if not lock:
+            yield self.get(key)
+        else:
+            locked = False
+            try:
+                data = self._get_or_lock(key)
+                locked = data is None
+                yield data
+            finally:
+                if locked:
+                    self._release_lock(key)
+
+    def _get_or_lock(self, key):
+        while True:
+            with self._mutex:
+                data = self.get(key)
+                if data is not None:
+                    return data
+                event = self._locks.get(key)
+                if event is None:
+                    self._locks[key] = threading.Event()
+                    return None
+            # Locked by someone else, wait for them to cache, take over lock if they are stuck
+            if not event.wait(LOCK_TIMEOUT):
+                with self._mutex:
+                    if self._locks.get(key) is event:
+                        del self._locks[key]
+
+    def _release_lock(self, key):
+        with self._mutex:
+            event = self._locks.pop(key, None)
+        if event is not None:
+            event.set()
+
+    # Invalidation structures, same as in cache_thing.lua and invalidate.lua
+
+    def cache_thing(self, prefix, key, data, cond_dnfs, timeout):
+        # Make values same as they would be after passing through json to redis
+        cond_dnfs = json.loads(json.dumps(cond_dnfs, default=str))
+        with self._mutex:
+            self._set(key, data, timeout)
+            for db_table, disj in cond_dnfs.items():
+                for conj in disj:
+                    eq_conj, field, special = _split_special(conj)
+                    schema = tuple(sorted(eq_conj))
+                    parts = frozenset((f, _lua_str(v)) for f, v in eq_conj.items())
+                    if isinstance(special, dict):
+                        self._ischemes[prefix, db_table].add((field, schema))
+                        values = set(map(_lua_str, special['in']))
+                        self._ref('_ins', (prefix, db_table, field, parts), key, values)
+                    elif special is not None:
+                        self._rschemes[prefix, db_table].add((field, schema))
+                        self._ref('_ranges', (prefix, db_table, field, parts), key, special)
+                    else:
+                        self._schemes[prefix, db_table].add(schema)
+                        self._ref('_conjs', (prefix, db_table, parts), key)
+
+    def invalidate_dict(self, prefix, db_table, obj_dict, scores):
+        obj_dict = json.loads(json.dumps(obj_dict, default=str))
+
+        def obj_parts(schema):
+            return frozenset((f, _lua_str(obj_dict.get(f, MISSING))) for f in schema)
+
+        with self._mutex:
+            stale = set()
+            for schema in self._schemes[prefix, db_table]:
+                stale.update(self._conjs.get((prefix, db_table, obj_parts(schema)), ()))
+
+            # NULLs are never in range or in __in list
+            for field, schema in self._rschemes[prefix, db_table]:
+                score = scores.get(field)
+                if score is None:
+                    continue
+                ranges = self._ranges.get((prefix, db_table, field, obj_parts(schema)), {})
+                stale.update(key for key, (lo, hi) in ranges.items()
+                             if (lo is None or lo <= score) and (hi is None or score <= hi))
+
+            for field, schema in self._ischemes[prefix, db_table]:
+                val = obj_dict.get(field)
+                if val is None:
+                    continue
+                ins = self._ins.get((prefix, db_table, field, obj_parts(schema)), {})
+                val = _lua_str(val)
+                stale.update(key for key, values in ins.items() if val in values)
+
+            for key in stale:
+                self._discard(key)
+
+    def invalidate_model(self, prefix, db_table):
+        with self._mutex:
+            stale = set()
+            for store in (self._conjs, self._ranges, self._ins):
+                for index_key, keys in store.items():
+                    if index_key[:2] == (prefix, db_table):
+                        stale.update(keys)
+            for key in stale:
+                self._discard(key)
+
+
+@memoize
+def get_backend():
+    return import_string(settings.CACHEOPS_BACKEND)(**settings.CACHEOPS_BACKEND_OPTIONS)
+
+setting_changed.connect(
+    lambda setting, **kw: setting.startswith('CACHEOPS_BACKEND') and get_backend.memory.clear(),
+    weak=False)
+
+
+class BackendProxy(object):
+    """
+    Refers to configured backend, which could change when overriding settings in tests.
+    """
+    def __getattr__(self, name):
+        return getattr(get_backend(), name)
+
+backend = BackendProxy()
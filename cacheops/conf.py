@@ -13,17 +13,31 @@ ALL_OPS = {'get', 'fetch', 'count', 'aggregate', 'exists'}
 
 class Defaults(namespace):
     CACHEOPS_ENABLED = True
+    CACHEOPS_BACKEND = 'cacheops.backends.RedisBackend'
+    CACHEOPS_BACKEND_OPTIONS = {}
     CACHEOPS_REDIS = {}
+    CACHEOPS_POOL = {}
     CACHEOPS_DEFAULTS = {}
     CACHEOPS = {}
     CACHEOPS_PREFIX = lambda query: ''
     CACHEOPS_LRU = False
+    CACHEOPS_FUNCTIONS = False
+    CACHEOPS_LEGACY_FUNC_KEYS = False
+    CACHEOPS_FUNC_IDENTITY = 'line'
     CACHEOPS_CLIENT_CLASS = None
     CACHEOPS_DEGRADE_ON_FAILURE = False
+    CACHEOPS_CIRCUIT_BREAKER = None
     CACHEOPS_SENTINEL = {}
+    CACHEOPS_CLUSTER = False
+    CACHEOPS_SHARDS = {}
+    CACHEOPS_REPLICAS = []
+    CACHEOPS_REPLICA_MAX_LAG = None
+    CACHEOPS_CLIENT_TRACKING = None
+    CACHEOPS_TRANSACTION_CACHE = False
 
     FILE_CACHE_DIR = '/tmp/cacheops_file_cache'
     FILE_CACHE_TIMEOUT = 60*60*24*30
+    FILE_CACHE_MAX_SIZE = None
 
 
 class Settings(object):
@@ -49,6 +63,8 @@ def prepare_profiles():
         'local_get': False,
         'db_agnostic': True,
         'lock': False,
+        'range_index': (),
+        'read_budget': None,
     }
     profile_defaults.update(settings.CACHEOPS_DEFAULTS)
 
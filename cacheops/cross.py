@@ -25,6 +25,16 @@ else:
 def md5hex(s):
     return md5(s).hexdigest()
 
+# Hash for function cache keys, blake2b is faster than md5, fall back to md5 in python 2.
+# Both take bytes and make 32 hex digits.
+try:
+    from hashlib import blake2b
+
+    def key_hasher(b=b''):
+        return blake2b(b, digest_size=16)
+except ImportError:
+    key_hasher = hashlib.md5
+
 
 # TODO: use django.utils.inspect.getargspec from Django 1.9
 import inspect
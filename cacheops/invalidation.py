@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
-import json
 import threading
 from funcy import memoize, post_processing, ContextDecorator
 from django.db import DEFAULT_DB_ALIAS
 from django.db.models.expressions import F, Expression
-from distutils.version import StrictVersion
 
 from .conf import settings
-from .utils import NOT_SERIALIZED_FIELDS
+from .utils import NOT_SERIALIZED_FIELDS, range_index_fields, range_score
 from .sharding import get_prefix
-from .redis import redis_client, handle_connection_failure, load_script
+from .redis import handle_invalidation_failure
+from .backends import backend
 from .signals import cache_invalidated
 from .transaction import queue_when_in_transaction
 
@@ -17,23 +16,15 @@ from .transaction import queue_when_in_transaction
 __all__ = ('invalidate_obj', 'invalidate_model', 'invalidate_all', 'no_invalidation')
 
 
-@memoize
-def redis_can_unlink():
-    redis_version = redis_client.info()['redis_version']
-    return StrictVersion(redis_version) >= StrictVersion('4.0')
-
-
 @queue_when_in_transaction
-@handle_connection_failure
+@handle_invalidation_failure
 def invalidate_dict(model, obj_dict, using=DEFAULT_DB_ALIAS):
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
     model = model._meta.concrete_model
-    prefix = get_prefix(_cond_dnfs=[(model._meta.db_table, list(obj_dict.items()))], dbs=[using])
-    load_script('invalidate', strip=redis_can_unlink())(keys=[prefix], args=[
-        model._meta.db_table,
-        json.dumps(obj_dict, default=str)
-    ])
+    prefix = get_prefix(_cond_dnfs={model._meta.db_table: [list(obj_dict.items())]}, dbs=[using])
+    backend.invalidate_dict(prefix, model._meta.db_table, obj_dict,
+                            get_obj_scores(model, obj_dict))
     cache_invalidated.send(sender=model, obj_dict=obj_dict)
 
 
@@ -46,7 +37,7 @@ def invalidate_obj(obj, using=DEFAULT_DB_ALIAS):
 
 
 @queue_when_in_transaction
-@handle_connection_failure
+@handle_invalidation_failure
 def invalidate_model(model, using=DEFAULT_DB_ALIAS):
     """
     Invalidates all caches for given model.
@@ -59,22 +50,15 @@ def invalidate_model(model, using=DEFAULT_DB_ALIAS):
     # NOTE: if we use sharding dependent on DNF then this will fail,
     #       which is ok, since it's hard/impossible to predict all the shards
     prefix = get_prefix(tables=[model._meta.db_table], dbs=[using])
-    conjs_keys = redis_client.keys('%sconj:%s:*' % (prefix, model._meta.db_table))
-    if conjs_keys:
-        cache_keys = redis_client.sunion(conjs_keys)
-        keys = list(cache_keys) + conjs_keys
-        if redis_can_unlink():
-            redis_client.execute_command('UNLINK', *keys)
-        else:
-            redis_client.delete(*keys)
+    backend.invalidate_model(prefix, model._meta.db_table)
     cache_invalidated.send(sender=model, obj_dict=None)
 
 
-@handle_connection_failure
+@handle_invalidation_failure
 def invalidate_all():
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
-    redis_client.flushdb()
+    backend.flush()
     cache_invalidated.send(sender=None, obj_dict=None)
 
 
@@ -105,6 +89,15 @@ def serializable_fields(model):
     return tuple(f for f in model._meta.fields
                    if not isinstance(f, NOT_SERIALIZED_FIELDS))
 
+@post_processing(dict)
+def get_obj_scores(model, obj_dict):
+    """
+    Returns range index scores for object values, NULLs are skipped as never being in range.
+    """
+    for attname in range_index_fields(model):
+        if obj_dict.get(attname) is not None:
+            yield attname, range_score(obj_dict[attname])
+
 @post_processing(dict)
 def get_obj_dict(model, obj):
     for field in serializable_fields(model):
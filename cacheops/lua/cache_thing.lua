@@ -20,25 +20,87 @@ local conj_schema = function (conj)
     return table.concat(parts, ',')
 end
 
-local conj_cache_key = function (db_table, conj)
+local conj_parts = function (conj)
     local parts = {}
     for field, val in pairs(conj) do
         table.insert(parts, field .. '=' .. tostring(val))
     end
 
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return table.concat(parts, '&')
+end
+
+local conj_cache_key = function (db_table, conj)
+    return prefix .. 'conj:' .. db_table .. ':' .. conj_parts(conj)
+end
+
+-- Range conds come as [lo, hi] lists and long __in ones as {"in": [...]},
+-- there is at most one of them per conj
+local split_special = function (conj)
+    for field, val in pairs(conj) do
+        if type(val) == 'table' then
+            local eq_conj = {}
+            for f, v in pairs(conj) do
+                if f ~= field then eq_conj[f] = v end
+            end
+            return eq_conj, field, val
+        end
+    end
+    return conj
+end
+
+local call_in_chunks = function (command, key, args)
+    local step = 1000
+    for i = 1, #args, step do
+        redis.call(command, key, unpack(args, i, math.min(i + step - 1, #args)))
+    end
+end
+
+-- NOTE: scores are passed as strings to not lose precision in number to string conversion
+local score_str = function (score, default)
+    if score == cjson.null then return default end
+    return string.format('%.17g', score)
 end
 
 
 -- Update schemes and invalidators
 for db_table, disj in pairs(dnfs) do
     for _, conj in ipairs(disj) do
-        -- Ensure scheme is known
-        redis.call('sadd', prefix .. 'schemes:' .. db_table, conj_schema(conj))
+        local eq_conj, field, special = split_special(conj)
+        local conj_key
+
+        if special and special['in'] then
+            -- Ensure in scheme is known, register cache_key in in-set index
+            -- and store the values in a set bound to cache_key
+            local in_suffix = db_table .. ':' .. field .. ':' .. conj_parts(eq_conj)
+            redis.call('sadd', prefix .. 'ischemes:' .. db_table,
+                       field .. ':' .. conj_schema(eq_conj))
+            conj_key = prefix .. 'in:' .. in_suffix
+            redis.call('sadd', conj_key, key)
 
-        -- Add new cache_key to list of dependencies
-        local conj_key = conj_cache_key(db_table, conj)
-        redis.call('sadd', conj_key, key)
+            local values_key = key .. ':in:' .. in_suffix
+            local values = {}
+            for _, val in ipairs(special['in']) do
+                table.insert(values, tostring(val))
+            end
+            call_in_chunks('sadd', values_key, values)
+            -- Values are only needed while cache_key lives, in LRU mode too
+            redis.call('expire', values_key, timeout)
+        elseif special then
+            -- Ensure range scheme is known and register cache_key in range index
+            redis.call('sadd', prefix .. 'rschemes:' .. db_table,
+                       field .. ':' .. conj_schema(eq_conj))
+            conj_key = prefix .. 'range:' .. db_table .. ':' .. field .. ':'
+                       .. conj_parts(eq_conj)
+            redis.call('zadd', conj_key, score_str(special[1], '-inf'),
+                       score_str(special[2], '') .. ':' .. key)
+        else
+            -- Ensure scheme is known
+            redis.call('sadd', prefix .. 'schemes:' .. db_table, conj_schema(conj))
+
+            -- Add new cache_key to list of dependencies
+            conj_key = conj_cache_key(db_table, conj)
+            redis.call('sadd', conj_key, key)
+        end
         -- NOTE: an invalidator should live longer than any key it references.
         --       So we update its ttl on every key if needed.
         -- NOTE: if CACHEOPS_LRU is True when invalidators should be left persistent,
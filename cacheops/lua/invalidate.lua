@@ -1,6 +1,7 @@
 local prefix = KEYS[1]
 local db_table = ARGV[1]
 local obj = cjson.decode(ARGV[2])
+local scores = cjson.decode(ARGV[3])
 local conj_del_fn = 'unlink'
 -- If Redis version < 4.0 we can't use UNLINK
 -- TOSTRIP
@@ -8,22 +9,35 @@ conj_del_fn = 'del'
 -- /TOSTRIP
 
 -- Utility functions
-local conj_cache_key = function (db_table, scheme, obj)
+local conj_parts = function (scheme, obj)
     local parts = {}
     for field in string.gmatch(scheme, "[^,]+") do
         table.insert(parts, field .. '=' .. tostring(obj[field]))
     end
 
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return table.concat(parts, '&')
+end
+
+local conj_cache_key = function (db_table, scheme, obj)
+    return prefix .. 'conj:' .. db_table .. ':' .. conj_parts(scheme, obj)
 end
 
-local call_in_chunks = function (command, args)
+local call_in_chunks = function (command, args, key)
     local step = 1000
     for i = 1, #args, step do
-        redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        if key then
+            redis.call(command, key, unpack(args, i, math.min(i + step - 1, #args)))
+        else
+            redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        end
     end
 end
 
+-- Splits "field:scheme" entries of rschemes and ischemes sets
+local split_scheme = function (special_scheme)
+    return string.match(special_scheme, '^([^:]*):(.*)$')
+end
+
 
 -- Calculate conj keys
 local conj_keys = {}
@@ -45,3 +59,59 @@ if next(conj_keys) ~= nil then
         call_in_chunks('del', cache_keys)
     end
 end
+
+
+-- Find ranges containing object values, delete their cache keys and range entries
+local rschemes = redis.call('smembers', prefix .. 'rschemes:' .. db_table)
+for _, rscheme in ipairs(rschemes) do
+    local field, scheme = split_scheme(rscheme)
+    local score = scores[field]
+    -- NULLs are never in range
+    if score ~= nil then
+        local range_key = prefix .. 'range:' .. db_table .. ':' .. field .. ':'
+                          .. conj_parts(scheme, obj)
+        local entries = redis.call('zrangebyscore', range_key, '-inf', string.format('%.17g', score))
+        local cache_keys, stale = {}, {}
+        for _, entry in ipairs(entries) do
+            local hi, cache_key = string.match(entry, '^([^:]*):(.*)$')
+            if hi == '' or tonumber(hi) >= score then
+                table.insert(cache_keys, cache_key)
+                table.insert(stale, entry)
+            end
+        end
+        if next(cache_keys) ~= nil then
+            call_in_chunks('zrem', stale, range_key)
+            call_in_chunks('del', cache_keys)
+        end
+    end
+end
+
+
+-- Check long __in sets for object values, delete cache keys having them
+local ischemes = redis.call('smembers', prefix .. 'ischemes:' .. db_table)
+for _, ischeme in ipairs(ischemes) do
+    local field, scheme = split_scheme(ischeme)
+    local val = obj[field]
+    -- NULLs are never in __in list
+    if val ~= nil and val ~= cjson.null then
+        local in_suffix = db_table .. ':' .. field .. ':' .. conj_parts(scheme, obj)
+        local in_key = prefix .. 'in:' .. in_suffix
+        local stale = {}
+        for _, cache_key in ipairs(redis.call('smembers', in_key)) do
+            local values_key = cache_key .. ':in:' .. in_suffix
+            if redis.call('exists', cache_key) == 0 then
+                -- Expired, evicted or deleted elsewhere, prune it to keep this loop short
+                redis.call(conj_del_fn, values_key)
+                table.insert(stale, cache_key)
+            elseif redis.call('sismember', values_key, tostring(val)) == 1
+                    or redis.call('exists', values_key) == 0 then
+                -- Values set could be evicted before its cache key, invalidate to be safe
+                redis.call('del', cache_key, values_key)
+                table.insert(stale, cache_key)
+            end
+        end
+        if next(stale) ~= nil then
+            call_in_chunks('srem', stale, in_key)
+        end
+    end
+end
@@ -0,0 +1,9 @@
+local key = KEYS[1]
+local signal_key = KEYS[2]
+local timeout = tonumber(ARGV[1])
+
+local locked = redis.call('set', key, 'LOCK', 'nx', 'ex', timeout)
+if locked then
+    redis.call('del', signal_key)
+end
+return locked
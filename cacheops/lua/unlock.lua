@@ -0,0 +1,8 @@
+local key = KEYS[1]
+local signal_key = KEYS[2]
+
+if redis.call('get', key) == 'LOCK' then
+    redis.call('del', key)
+end
+redis.call('lpush', signal_key, 1)
+redis.call('expire', signal_key, 1)
@@ -1,8 +1,7 @@
-import os
-
 from django.core.management.base import BaseCommand
 
 from cacheops.conf import settings
+from cacheops.simple import FileCache
 
 
 class Command(BaseCommand):
@@ -10,9 +9,21 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('path', nargs='*', default=['default'])
+        parser.add_argument('--max-size', type=int, default=None,
+                            help='Also remove soonest expiring entries to fit into this many bytes')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report what would be removed')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of threads to scan cache dirs with')
 
     def handle(self, **options):
         for path in options['path']:
             if path == 'default':
                 path = settings.FILE_CACHE_DIR
-            os.system('find %s -type f \! -iname "\." -mmin +0 -delete' % path)
+            stats = FileCache(path).clean(max_size=options['max_size'],
+                                          dry_run=options['dry_run'],
+                                          workers=options['workers'])
+            self.stdout.write(
+                '%s: %s %d expired and %d evicted files freeing %d bytes, %d files of %d bytes left'
+                % (path, 'would remove' if options['dry_run'] else 'removed', stats['expired'],
+                   stats['evicted'], stats['freed'], stats['files'], stats['size']))
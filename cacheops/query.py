@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import sys
-import json
 import threading
 import six
 from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk, chain
@@ -17,10 +16,12 @@ from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 
 from .conf import model_profile, settings, ALL_OPS
-from .utils import monkey_mix, stamp_fields, func_cache_key, cached_view_fab, family_has_profile
+from .utils import monkey_mix, stamp_fields, func_cache_key, func_versions, cached_view_fab, \
+    family_has_profile
 from .sharding import get_prefix
-from .redis import redis_client, handle_connection_failure, load_script
-from .tree import dnfs
+from .redis import handle_connection_failure, late_gets
+from .backends import backend
+from .tree import dnfs, query_tables
 from .invalidation import invalidate_obj, invalidate_dict, no_invalidation
 from .transaction import transaction_states
 from .signals import cache_read
@@ -32,21 +33,28 @@ _local_get_cache = {}
 
 
 @handle_connection_failure
-def cache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=()):
+def cache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), tables=None):
     """
     Writes data to cache and creates appropriate invalidators.
     """
     # Could have changed after last check, sometimes superficially
-    if transaction_states.is_dirty(dbs):
+    if transaction_states.is_dirty(dbs, tables):
         return
-    load_script('cache_thing', settings.CACHEOPS_LRU)(
-        keys=[prefix, cache_key],
-        args=[
-            pickle.dumps(data, -1),
-            json.dumps(cond_dnfs, default=str),
-            timeout
-        ]
-    )
+    pickled_data = pickle.dumps(data, -1)
+
+    # Redis didn't answer in read budget, don't wait for it once more
+    late_get = late_gets.futures.pop(cache_key, None)
+    if late_get is not None and not late_get.done():
+        def write_on_miss(get):
+            if get.exception() is not None or get.result() is None:
+                _write_thing(prefix, cache_key, pickled_data, cond_dnfs, timeout)
+        late_get.add_done_callback(write_on_miss)
+    else:
+        _write_thing(prefix, cache_key, pickled_data, cond_dnfs, timeout)
+
+@handle_connection_failure
+def _write_thing(prefix, cache_key, pickled_data, cond_dnfs, timeout):
+    backend.cache_thing(prefix, cache_key, pickled_data, cond_dnfs, timeout)
 
 
 def cached_as(*samples, **kwargs):
@@ -58,6 +66,7 @@ def cached_as(*samples, **kwargs):
     extra = kwargs.pop('extra', None)
     key_func = kwargs.pop('key_func', func_cache_key)
     lock = kwargs.pop('lock', None)
+    version = kwargs.pop('version', None)
     if not samples:
         raise TypeError('Pass a queryset, a model or an object to cache like')
     if kwargs:
@@ -82,6 +91,8 @@ def cached_as(*samples, **kwargs):
 
     querysets = lmap(_get_queryset, samples)
     dbs = list({qs.db for qs in querysets})
+    tables = lmap(query_tables, querysets)
+    tables = None if None in tables else set().union(*tables)
     cond_dnfs = join_with(lcat, map(dnfs, querysets))
     key_extra = [qs._cache_key(prefix=False) for qs in querysets]
     key_extra.append(extra)
@@ -89,25 +100,36 @@ def cached_as(*samples, **kwargs):
         timeout = min(qs._cacheprofile['timeout'] for qs in querysets)
     if lock is None:
         lock = any(qs._cacheprofile['lock'] for qs in querysets)
+    budgets = [qs._cacheprofile['read_budget'] for qs in querysets
+               if qs._cacheprofile.get('read_budget')]
+    budget = min(budgets) if budgets else None
 
     def decorator(func):
+        if version is not None:
+            func_versions[func] = version
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs):
+            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs, tables):
                 return func(*args, **kwargs)
 
-            prefix = get_prefix(func=func, _cond_dnfs=cond_dnfs, dbs=dbs)
-            cache_key = prefix + 'as:' + key_func(func, args, kwargs, key_extra)
+            prefix, cache_key = get_cache_key(*args, **kwargs)
 
-            with redis_client.getting(cache_key, lock=lock) as cache_data:
+            with backend.getting(prefix, cache_key, lock=lock, budget=budget) as cache_data:
                 cache_read.send(sender=None, func=func, hit=cache_data is not None)
                 if cache_data is not None:
                     return pickle.loads(cache_data)
                 else:
                     result = func(*args, **kwargs)
-                    cache_thing(prefix, cache_key, result, cond_dnfs, timeout, dbs=dbs)
+                    cache_thing(prefix, cache_key, result, cond_dnfs, timeout,
+                                dbs=dbs, tables=tables)
                     return result
 
+        def get_cache_key(*args, **kwargs):
+            prefix = get_prefix(func=func, _cond_dnfs=cond_dnfs, dbs=dbs)
+            return prefix, prefix + 'as:' + key_func(func, args, kwargs, key_extra)
+        wrapper.cache_key = get_cache_key
+
         return wrapper
     return decorator
 
@@ -176,9 +198,14 @@ class QuerySetMixin(object):
     def _cond_dnfs(self):
         return dnfs(self)
 
+    @cached_property
+    def _tables(self):
+        return query_tables(self)
+
     def _cache_results(self, cache_key, results):
         cache_thing(self._prefix, cache_key, results,
-                    self._cond_dnfs, self._cacheprofile['timeout'], dbs=[self.db])
+                    self._cond_dnfs, self._cacheprofile['timeout'],
+                    dbs=[self.db], tables=self._tables)
 
     def cache(self, ops=None, timeout=None, lock=None):
         """
@@ -265,18 +292,25 @@ class QuerySetMixin(object):
             return clone
 
     def _fetch_all(self):
-        # If already fetched, cache not enabled, within write or in dirty transaction then fall back
+        # If already fetched, cache not enabled or within write then fall back
         if self._result_cache is not None \
                 or not settings.CACHEOPS_ENABLED \
                 or not self._cacheprofile or 'fetch' not in self._cacheprofile['ops'] \
-                or self._for_write \
-                or transaction_states[self.db].is_dirty():
+                or self._for_write:
+            return self._no_monkey._fetch_all(self)
+
+        # In a transaction dirty for any of the tables we read
+        state = transaction_states[self.db]
+        if state.is_dirty() and state.is_dirty(self._tables):
+            if settings.CACHEOPS_TRANSACTION_CACHE:
+                return self._fetch_all_transaction_cache(state)
             return self._no_monkey._fetch_all(self)
 
         cache_key = self._cache_key()
         lock = self._cacheprofile['lock']
+        budget = self._cacheprofile.get('read_budget')
 
-        with redis_client.getting(cache_key, lock=lock) as cache_data:
+        with backend.getting(self._prefix, cache_key, lock=lock, budget=budget) as cache_data:
             cache_read.send(sender=self.model, func=None, hit=cache_data is not None)
             if cache_data is not None:
                 self._result_cache = pickle.loads(cache_data)
@@ -293,6 +327,24 @@ class QuerySetMixin(object):
 
         return self._no_monkey._fetch_all(self)
 
+    def _fetch_all_transaction_cache(self, state):
+        """
+        Caches results in memory till the end of transaction or a write to any of the tables read.
+        Never goes to redis, so other transactions don't see this.
+        """
+        cache_key = self._cache_key()
+        cache_data = state.get_read(cache_key)
+        if cache_data is not None:
+            self._result_cache = pickle.loads(cache_data)
+        else:
+            if hasattr(self, '_iterable_class'):
+                self._result_cache = list(self._iterable_class(self))
+            else:
+                self._result_cache = list(self.iterator())
+            state.set_read(cache_key, self._tables, pickle.dumps(self._result_cache, -1))
+
+        return self._no_monkey._fetch_all(self)
+
     def count(self):
         if self._cacheprofile and 'count' in self._cacheprofile['ops']:
             # Optmization borrowed from overriden method:
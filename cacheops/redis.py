@@ -1,40 +1,330 @@
 from __future__ import absolute_import
+import os
+import sys
+import time
+import random
+import weakref
 import warnings
+import threading
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from functools import partial
 import six
 
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.encoding import force_text
 from django.utils.module_loading import import_string
 
 from funcy import decorator, identity, memoize, LazyObject
 import redis
+# Python 2 needs futures backport for read budgets
+try:
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+except ImportError:
+    ThreadPoolExecutor = None
 from redis.sentinel import Sentinel
-from .conf import settings
+# Cluster client appeared in redis-py 4.1
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+from .conf import settings, Defaults
+from .sharding import HashRing, same_slot_key
+from .signals import cache_circuit_changed
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling redis after several consecutive failures for a while,
+    then lets a single probe call through to see if it's back.
+    """
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.dropped_invalidations = 0
+
+    @property
+    def options(self):
+        return settings.CACHEOPS_CIRCUIT_BREAKER
+
+    def allow(self, invalidation=False):
+        if self.state == 'closed':
+            return True
+        with self._mutex:
+            if self.state == 'open' and not self.probing \
+                    and time.time() - self.opened_at >= self.options.get('reset_timeout', 10):
+                self.probing = True
+                self._set_state('half-open')
+                return True
+            if invalidation:
+                self.dropped_invalidations += 1
+            return False
+
+    def success(self):
+        if self.state == 'closed' and not self.failures:
+            return
+        with self._mutex:
+            self.failures = 0
+            self.probing = False
+            if self.state != 'closed':
+                dropped, self.dropped_invalidations = self.dropped_invalidations, 0
+                self._set_state('closed', dropped_invalidations=dropped)
+
+    def failure(self):
+        if not self.options:
+            return
+        with self._mutex:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half-open' or \
+                    self.state == 'closed' and self.failures >= self.options.get('failures', 5):
+                self.opened_at = time.time()
+                self._set_state('open')
+
+    def release(self):
+        """
+        Lets next probe through when this one failed for some reason other than redis.
+        """
+        if not self.probing:
+            return
+        with self._mutex:
+            if self.probing:
+                self.probing = False
+                self._set_state('open')
+
+    def _set_state(self, state, dropped_invalidations=0):
+        self.state = state
+        cache_circuit_changed.send(sender=None, state=state,
+                                   dropped_invalidations=dropped_invalidations)
+
+circuit_breaker = CircuitBreaker()
+
+
+def _handle_failure(call, invalidation=False):
+    if not circuit_breaker.allow(invalidation):
+        return None
+    try:
+        result = call()
+    except redis.ConnectionError as e:
+        circuit_breaker.failure()
+        warnings.warn("The cacheops cache is unreachable! Error: %s" % e, RuntimeWarning)
+    except redis.TimeoutError as e:
+        circuit_breaker.failure()
+        warnings.warn("The cacheops cache timed out! Error: %s" % e, RuntimeWarning)
+    except Exception:
+        # Not a redis failure, but a probe should not leave breaker half-open forever
+        circuit_breaker.release()
+        raise
+    else:
+        if script_batch.pipelines is None:
+            circuit_breaker.success()
+        else:
+            # Call was only queued, executing the batch will tell whether redis is fine
+            circuit_breaker.release()
+        return result
 
 
 if settings.CACHEOPS_DEGRADE_ON_FAILURE:
     @decorator
     def handle_connection_failure(call):
-        try:
-            return call()
-        except redis.ConnectionError as e:
-            warnings.warn("The cacheops cache is unreachable! Error: %s" % e, RuntimeWarning)
-        except redis.TimeoutError as e:
-            warnings.warn("The cacheops cache timed out! Error: %s" % e, RuntimeWarning)
+        return _handle_failure(call)
+
+    # Invalidations skipped while circuit is open are counted
+    @decorator
+    def handle_invalidation_failure(call):
+        return _handle_failure(call, invalidation=True)
 else:
-    handle_connection_failure = identity
+    handle_connection_failure = handle_invalidation_failure = identity
 
 
 LOCK_TIMEOUT = 60
+REPLICA_CHECK_INTERVAL = 1
+# Read from master for this long after own invalidation, unless CACHEOPS_REPLICA_MAX_LAG is bigger
+REPLICA_MASTER_WINDOW = 1
+# Used when CACHEOPS_POOL doesn't limit connections
+READ_POOL_SIZE = 16
+TRACKING_RECONNECT_INTERVAL = 1
+TRACKING_PING_INTERVAL = 1
+
+
+class LateGets(threading.local):
+    """
+    Gets which didn't fit into read budget by cache key, these are still running.
+    """
+    def __init__(self):
+        self.futures = weakref.WeakValueDictionary()
+
+late_gets = LateGets()
+
+@memoize
+def _read_executor():
+    if ThreadPoolExecutor is None:
+        raise ImproperlyConfigured("Cacheops read_budget requires futures package in Python 2")
+    # There is no point in running more gets than there are connections
+    return ThreadPoolExecutor(
+        max_workers=settings.CACHEOPS_POOL.get('max_connections') or READ_POOL_SIZE)
+
+
+class LocalCache(object):
+    """
+    Keeps recently read values in process memory, relies on redis client tracking
+    in broadcast mode to learn which keys were changed or deleted.
+    Invalidation messages are listened for in a thread, the whole cache is dropped on disconnect.
+    """
+    def __init__(self, client, prefixes=None, max_entries=1000):
+        self.client = client
+        if prefixes is None:
+            # With custom prefixes we can't know where cache keys start, so track everything
+            prefixes = ('q:', 'as:') if settings.CACHEOPS_PREFIX is Defaults.CACHEOPS_PREFIX \
+                else ('',)
+        self.prefixes = prefixes
+        self.max_entries = max_entries
+        self.active = False
+        self._mutex = threading.Lock()
+        self._data = OrderedDict()
+        self._reading = {}
+        self._thread = None
+        self._pid = None
+
+    def get(self, key, fetch):
+        if not self._listening():
+            return fetch(key)
+
+        token = object()
+        with self._mutex:
+            data = self._data.pop(key, None)
+            if data is not None:
+                # A simple LRU, pop and set moves key to the end
+                self._data[key] = data
+                return data
+            self._reading[key] = token
+
+        try:
+            data = fetch(key)
+        finally:
+            with self._mutex:
+                # Only save data if no invalidation for this key came while we were reading it
+                if self._reading.get(key) is token:
+                    del self._reading[key]
+                    if self.active and data is not None and data != b'LOCK':
+                        self._data[key] = data
+                        while len(self._data) > self.max_entries:
+                            self._data.popitem(last=False)
+        return data
 
+    def forget(self, keys=None):
+        with self._mutex:
+            if keys is None:
+                self._data.clear()
+                self._reading.clear()
+            else:
+                for key in keys:
+                    self._data.pop(key, None)
+                    self._reading.pop(key, None)
 
-class CacheopsRedis(redis.StrictRedis):
-    get = handle_connection_failure(redis.StrictRedis.get)
+    def _listening(self):
+        # Threads don't survive fork, so each process starts its own
+        if self._pid != os.getpid():
+            with self._mutex:
+                if self._pid != os.getpid():
+                    self.active = False
+                    self._data.clear()
+                    self._thread = threading.Thread(target=self._listen, name='cacheops-tracking')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self.active
+
+    def _listen(self):
+        pool = self.client.connection_pool
+        while True:
+            conn = pool.connection_class(
+                **dict(pool.connection_kwargs, socket_timeout=TRACKING_PING_INTERVAL))
+            try:
+                conn.send_command('CLIENT', 'ID')
+                client_id = conn.read_response()
+                # Redirect invalidation messages to the same connection
+                command = ['CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST']
+                for prefix in self.prefixes:
+                    command.extend(['PREFIX', prefix])
+                conn.send_command(*command)
+                conn.read_response()
+                conn.send_command('SUBSCRIBE', '__redis__:invalidate')
+                conn.read_response()
+                self.active = True
+
+                pinged = False
+                while True:
+                    # A silently dropped connection is only noticed by not answering a ping
+                    if not conn.can_read(timeout=TRACKING_PING_INTERVAL):
+                        if pinged:
+                            raise redis.TimeoutError('No answer to PING')
+                        conn.send_command('PING')
+                        pinged = True
+                        continue
+                    message = conn.read_response()
+                    pinged = False
+                    if message[0] == b'message':
+                        # None means flushdb or flushall
+                        keys = message[2]
+                        self.forget(None if keys is None else [force_text(k) for k in keys])
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                warnings.warn("Cacheops client tracking connection failed: %s" % e, RuntimeWarning)
+            except redis.ResponseError as e:
+                warnings.warn("Cacheops client tracking is not available: %s" % e, RuntimeWarning)
+                return
+            finally:
+                self.active = False
+                self.forget()
+                conn.disconnect()
+            time.sleep(TRACKING_RECONNECT_INTERVAL)
+
+
+_local_cache_lock = threading.Lock()
+
+
+class CacheopsRedisMixin(object):
+    replicas = ()
+    _master_until = 0
+
+    @property
+    def local_cache(self):
+        options = settings.CACHEOPS_CLIENT_TRACKING
+        if not options:
+            return None
+        if self.__dict__.get('_local_cache') is None:
+            with _local_cache_lock:
+                if self.__dict__.get('_local_cache') is None:
+                    self._local_cache = LocalCache(self, **options)
+        return self._local_cache
+
+    def forget_local(self):
+        """
+        Drops local cache after invalidation made by this process, for it to see its own writes.
+        Replicas could still have invalidated data, so reads go to master for a while too.
+        """
+        if self.__dict__.get('_local_cache') is not None:
+            self._local_cache.forget()
+        if self.replicas:
+            window = max(settings.CACHEOPS_REPLICA_MAX_LAG or 0, REPLICA_MASTER_WINDOW)
+            self._master_until = time.time() + window
+
+    @handle_connection_failure
+    def get(self, key):
+        return super(CacheopsRedisMixin, self).get(key)
 
     @contextmanager
-    def getting(self, key, lock=False):
+    def getting(self, key, lock=False, budget=None):
         if not lock:
-            yield self.get(key)
+            local_cache = self.local_cache
+            # Only master reads are tracked, so local cache can't be filled from a lagging replica
+            get = self.replica_get if local_cache is None else self.get
+            fetch = partial(self.budget_get, budget=budget, get=get) if budget else get
+            yield local_cache.get(key, fetch) if local_cache is not None else fetch(key)
         else:
             locked = False
             try:
@@ -45,21 +335,91 @@ class CacheopsRedis(redis.StrictRedis):
                 if locked:
                     self._release_lock(key)
 
+    def replica_get(self, key):
+        """
+        Gets key from a replica with acceptable lag if there is any, from master otherwise.
+        """
+        replica = self._pick_replica()
+        if replica is not None:
+            try:
+                return super(CacheopsRedisMixin, replica).get(key)
+            except (redis.ConnectionError, redis.TimeoutError):
+                self._replica_states[replica] = (time.time(), False)
+        return self.get(key)
+
+    def budget_get(self, key, budget, get=None):
+        """
+        Gets key waiting for at most budget seconds, returns None if redis is slower.
+        Such late gets are remembered to postpone writing to cache till they answer.
+        """
+        # Budget starts when get does, waiting in executor queue is not redis slowness
+        started = []
+        started_event = threading.Event()
+
+        def timed_get(key):
+            started.append(time.time())
+            started_event.set()
+            return (get or self.replica_get)(key)
+
+        future = _read_executor().submit(timed_get, key)
+        started_event.wait()
+        try:
+            return future.result(timeout=max(0, started[0] + budget - time.time()))
+        except FutureTimeoutError:
+            late_gets.futures[key] = future
+            return None
+
+    def _pick_replica(self):
+        if not self.replicas or time.time() < self._master_until:
+            return None
+        good = [replica for replica in self.replicas if self._replica_ok(replica)]
+        return random.choice(good) if good else None
+
+    def _replica_ok(self, replica):
+        self._replica_states = getattr(self, '_replica_states', {})
+        checked, ok = self._replica_states.get(replica, (0, False))
+        now = time.time()
+        if now - checked < REPLICA_CHECK_INTERVAL:
+            return ok
+
+        max_lag = settings.CACHEOPS_REPLICA_MAX_LAG
+        if max_lag is None:
+            ok = True
+        else:
+            try:
+                offsets = self._master_offsets(now, max_lag)
+                info = replica.info('replication')
+            except (redis.ConnectionError, redis.TimeoutError):
+                ok = False
+            else:
+                # Replica is fresh enough if it has everything master had max_lag seconds ago
+                replica_offset = info.get('slave_repl_offset', -1)
+                ok = info.get('master_link_status') == 'up' \
+                    and any(replica_offset >= offset for t, offset in offsets if t >= now - max_lag)
+        self._replica_states[replica] = (now, ok)
+        return ok
+
+    def _master_offsets(self, now, max_lag):
+        """
+        Returns (time, offset) samples of master replication offset, taken once in check interval.
+        Comparing replica offset to these tells how many seconds behind it is.
+        """
+        self._offsets = getattr(self, '_offsets', deque())
+        if not self._offsets or now - self._offsets[-1][0] >= REPLICA_CHECK_INTERVAL:
+            offset = self.info('replication')['master_repl_offset']
+            self._offsets.append((now, offset))
+        while len(self._offsets) > 1 and self._offsets[1][0] <= now - max_lag:
+            self._offsets.popleft()
+        return list(self._offsets)
+
     @handle_connection_failure
     def _get_or_lock(self, key):
-        self._lock = getattr(self, '_lock', self.register_script("""
-            local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
-            if locked then
-                redis.call('del', KEYS[2])
-            end
-            return locked
-        """))
-        signal_key = key + ':signal'
+        signal_key = same_slot_key(key, ':signal')
 
         while True:
             data = self.get(key)
             if data is None:
-                if self._lock(keys=[key, signal_key], args=[LOCK_TIMEOUT]):
+                if load_script('lock')(keys=[key, signal_key], args=[LOCK_TIMEOUT], client=self):
                     return None
             elif data != b'LOCK':
                 return data
@@ -69,57 +429,330 @@ class CacheopsRedis(redis.StrictRedis):
 
     @handle_connection_failure
     def _release_lock(self, key):
-        self._unlock = getattr(self, '_unlock', self.register_script("""
-            if redis.call('get', KEYS[1]) == 'LOCK' then
-                redis.call('del', KEYS[1])
-            end
-            redis.call('lpush', KEYS[2], 1)
-            redis.call('expire', KEYS[2], 1)
-        """))
-        signal_key = key + ':signal'
-        self._unlock(keys=[key, signal_key])
+        signal_key = same_slot_key(key, ':signal')
+        load_script('unlock')(keys=[key, signal_key], client=self)
+
+
+class CacheopsRedis(CacheopsRedisMixin, redis.StrictRedis):
+    pass
+
+if RedisCluster is not None:
+    class CacheopsRedisCluster(CacheopsRedisMixin, RedisCluster):
+        pass
+
+
+def get_client_class():
+    if settings.CACHEOPS_CLIENT_CLASS:
+        return import_string(settings.CACHEOPS_CLIENT_CLASS)
+    elif settings.CACHEOPS_CLUSTER:
+        if RedisCluster is None:
+            raise ImproperlyConfigured("CACHEOPS_CLUSTER requires redis-py 4.1 or later, "
+                                       "or CACHEOPS_CLIENT_CLASS set to a cluster client")
+        return CacheopsRedisCluster
+    else:
+        return CacheopsRedis
+
+class CacheopsConnectionPool(redis.BlockingConnectionPool):
+    """
+    A blocking pool, which keeps stats on connections and their acquiring.
+    """
+    def reset(self):
+        super(CacheopsConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self.created = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.acquire_time = 0
+        self.max_acquire_time = 0
+
+    def make_connection(self):
+        with self._stats_lock:
+            self.created += 1
+        return super(CacheopsConnectionPool, self).make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        with self._stats_lock:
+            self.waiting += 1
+        try:
+            return super(CacheopsConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+        finally:
+            elapsed = time.time() - start
+            with self._stats_lock:
+                self.waiting -= 1
+                self.acquired += 1
+                self.acquire_time += elapsed
+                self.max_acquire_time = max(self.max_acquire_time, elapsed)
+
+    def prewarm(self, count):
+        """
+        Opens up to count connections, so that first requests don't wait for them.
+        """
+        connections = [self.get_connection('PING') for _ in range(min(count, self.max_connections))]
+        for connection in connections:
+            self.release(connection)
+
+    def stats(self):
+        # Pool queue holds idle connections and None placeholders for not yet created ones
+        idle = sum(1 for c in list(self.pool.queue) if c is not None)
+        return {
+            'max_connections': self.max_connections,
+            'created': self.created,
+            'in_use': len(self._connections) - idle,
+            'idle': idle,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'acquire_time': self.acquire_time,
+            'max_acquire_time': self.max_acquire_time,
+        }
+
+
+def make_client(conf, client_class):
+    # Allow client connection settings to be specified by a URL.
+    if isinstance(conf, six.string_types):
+        client = client_class.from_url(conf)
+    else:
+        client = client_class(**conf)
+
+    if settings.CACHEOPS_POOL and hasattr(client, 'connection_pool'):
+        pool = client.connection_pool
+        client.connection_pool = CacheopsConnectionPool(
+            max_connections=settings.CACHEOPS_POOL.get('max_connections', 50),
+            timeout=settings.CACHEOPS_POOL.get('timeout', 20),
+            connection_class=pool.connection_class,
+            **pool.connection_kwargs)
+    return client
 
 
 @LazyObject
 def redis_client():
     if settings.CACHEOPS_REDIS and settings.CACHEOPS_SENTINEL:
         raise ImproperlyConfigured("CACHEOPS_REDIS and CACHEOPS_SENTINEL are mutually exclusive")
+    if settings.CACHEOPS_CLUSTER and settings.CACHEOPS_SENTINEL:
+        raise ImproperlyConfigured("CACHEOPS_CLUSTER and CACHEOPS_SENTINEL are mutually exclusive")
+    if settings.CACHEOPS_CLUSTER and settings.CACHEOPS_CLIENT_TRACKING:
+        raise ImproperlyConfigured(
+            "CACHEOPS_CLIENT_TRACKING is not supported with CACHEOPS_CLUSTER")
 
-    client_class = CacheopsRedis
-    if settings.CACHEOPS_CLIENT_CLASS:
-        client_class = import_string(settings.CACHEOPS_CLIENT_CLASS)
+    client_class = get_client_class()
 
     if settings.CACHEOPS_SENTINEL:
         if not {'locations', 'service_name'} <= set(settings.CACHEOPS_SENTINEL):
             raise ImproperlyConfigured("Specify locations and service_name for CACHEOPS_SENTINEL")
 
         sentinel = Sentinel(settings.CACHEOPS_SENTINEL['locations'])
-        return sentinel.master_for(
-            settings.CACHEOPS_SENTINEL['service_name'],
+        options = dict(
             redis_class=client_class,
             db=settings.CACHEOPS_SENTINEL.get('db', 0),
             socket_timeout=settings.CACHEOPS_SENTINEL.get('socket_timeout')
         )
+        client = sentinel.master_for(settings.CACHEOPS_SENTINEL['service_name'], **options)
+        if settings.CACHEOPS_SENTINEL.get('replicas'):
+            client.replicas = [
+                sentinel.slave_for(settings.CACHEOPS_SENTINEL['service_name'], **options)
+            ]
+        return client
 
-    # Allow client connection settings to be specified by a URL.
-    if isinstance(settings.CACHEOPS_REDIS, six.string_types):
-        return client_class.from_url(settings.CACHEOPS_REDIS)
-    else:
-        return client_class(**settings.CACHEOPS_REDIS)
+    client = make_client(settings.CACHEOPS_REDIS, client_class)
+    client.replicas = [make_client(conf, client_class) for conf in settings.CACHEOPS_REPLICAS]
+    return client
+
+
+### Sharding
+
+@memoize
+def _shards():
+    if settings.CACHEOPS_CLUSTER:
+        raise ImproperlyConfigured("CACHEOPS_CLUSTER and CACHEOPS_SHARDS are mutually exclusive")
+
+    client_class = get_client_class()
+    clients = {name: make_client(conf, client_class)
+               for name, conf in settings.CACHEOPS_SHARDS.items()}
+    return HashRing(clients), clients
+
+setting_changed.connect(
+    lambda setting, **kw: setting == 'CACHEOPS_SHARDS' and _shards.memory.clear(), weak=False)
+
+def shard_client(prefix):
+    """
+    Returns a client for redis storing keys with this prefix and their invalidation structures.
+    """
+    if not settings.CACHEOPS_SHARDS:
+        return redis_client
+    ring, clients = _shards()
+    return clients[ring.get(prefix)]
+
+def all_clients():
+    if not settings.CACHEOPS_SHARDS:
+        return [redis_client]
+    return [redis_client] + list(_shards()[1].values())
+
+def prewarm_pools():
+    count = settings.CACHEOPS_POOL.get('prewarm')
+    if not count:
+        return
+    for client in all_clients():
+        if isinstance(client.connection_pool, CacheopsConnectionPool):
+            try:
+                client.connection_pool.prewarm(count)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                warnings.warn("Failed to prewarm cacheops connections: %s" % e, RuntimeWarning)
+
+def pool_stats():
+    """
+    Returns connection pool stats of this process by client, shards go by their names.
+    """
+    clients = dict(_shards()[1], default=redis_client) if settings.CACHEOPS_SHARDS \
+        else {'default': redis_client}
+    return {name: client.connection_pool.stats() for name, client in clients.items()
+            if isinstance(getattr(client, 'connection_pool', None), CacheopsConnectionPool)}
 
 
 ### Lua script loader
 
 import re
 import os.path
+import hashlib
+
+STRIP_RE = re.compile(r'TOSTRIP.*?/TOSTRIP', re.S)
+SCRIPTS = ('cache_thing', 'invalidate', 'lock', 'unlock')
+LIBRARY = 'cacheops'
+
+
+class LuaScript(object):
+    """
+    A script called with EVALSHA or as a redis 7 function with FCALL.
+    Reloads itself and retries once if redis lost it, in pipelines this is done on execute.
+    """
+    def __init__(self, name, code, strip=False):
+        self.code = code
+        self.sha = hashlib.sha1(code.encode('utf-8')).hexdigest()
+        self.function = '%s_%s%s' % (LIBRARY, name, '_stripped' if strip else '')
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None:
+            client = redis_client
+        if settings.CACHEOPS_FUNCTIONS:
+            command = ['FCALL', self.function, len(keys)] + list(keys) + list(args)
+        else:
+            command = ['EVALSHA', self.sha, len(keys)] + list(keys) + list(args)
+        if isinstance(client, redis.client.Pipeline):
+            return client.execute_command(*command)
+        try:
+            return client.execute_command(*command)
+        except redis.ResponseError as e:
+            if not is_missing_script(e):
+                raise
+            load_scripts(client)
+            return client.execute_command(*command)
 
-STRIP_RE = re.compile(r'TOSTRIP.*/TOSTRIP', re.S)
+def is_missing_script(error):
+    # NOTE: older redis-py versions raise plain ResponseError for NOSCRIPT in pipelines
+    message = str(error)
+    return isinstance(error, redis.exceptions.NoScriptError) \
+        or message.startswith('NOSCRIPT') or 'Function not found' in message
 
 @memoize
-def load_script(name, strip=False):
+def script_code(name, strip=False):
     filename = os.path.join(os.path.dirname(__file__), 'lua/%s.lua' % name)
     with open(filename) as f:
         code = f.read()
     if strip:
         code = STRIP_RE.sub('', code)
-    return redis_client.register_script(code)
+    return code
+
+@memoize
+def load_script(name, strip=False):
+    return LuaScript(name, script_code(name, strip), strip)
+
+def library_code():
+    """
+    All scripts in both variants as a redis 7 functions library.
+    """
+    parts = ['#!lua name=%s' % LIBRARY]
+    for name in SCRIPTS:
+        for strip in (False, True):
+            parts.append("redis.register_function('%s', function(KEYS, ARGV)\n%s\nend)"
+                         % (load_script(name, strip).function, script_code(name, strip)))
+    return '\n'.join(parts)
+
+def load_scripts(client):
+    """
+    Loads all scripts into redis, so that they could be called by sha or name right away.
+    """
+    if settings.CACHEOPS_FUNCTIONS:
+        client.execute_command('FUNCTION', 'LOAD', 'REPLACE', library_code())
+    else:
+        for name in SCRIPTS:
+            for strip in (False, True):
+                client.script_load(script_code(name, strip))
+
+def preload_scripts():
+    for client in all_clients():
+        try:
+            load_scripts(client)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            # Scripts will be loaded on first use then
+            warnings.warn("Failed to preload cacheops scripts: %s" % e, RuntimeWarning)
+
+
+### Script batching
+
+class ScriptBatch(threading.local):
+    pipelines = None
+
+    def pipeline_for(self, client):
+        """
+        Returns a pipeline to send script calls to client with, client itself if not batching.
+        """
+        if self.pipelines is None:
+            return client
+        if client not in self.pipelines:
+            self.pipelines[client] = client.pipeline(transaction=False)
+        return self.pipelines[client]
+
+script_batch = ScriptBatch()
+
+@contextmanager
+def batched_scripts():
+    """
+    Sends script calls passing client=script_batch.pipeline_for(...) in pipelines on exit.
+    """
+    # Cluster pipelines don't handle scripts well, so we just make calls one by one
+    if script_batch.pipelines is not None or settings.CACHEOPS_CLUSTER:
+        yield
+        return
+
+    script_batch.pipelines = {}
+    try:
+        yield
+    finally:
+        pipelines, script_batch.pipelines = script_batch.pipelines, None
+        # A failure on one shard shouldn't drop invalidations for others
+        errors = []
+        for client, pipeline in pipelines.items():
+            try:
+                _execute_batch(pipeline)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                client.forget_local()
+        if errors:
+            six.reraise(*errors[0])
+
+@handle_connection_failure
+def _execute_batch(pipeline):
+    commands = list(pipeline.command_stack)
+    results = pipeline.execute(raise_on_error=False)
+    # Redis could lose scripts on restart or failover, load them and resend failed calls
+    missing = [command for command, result in zip(commands, results)
+               if isinstance(result, redis.ResponseError) and is_missing_script(result)]
+    if missing:
+        load_scripts(pipeline)
+        for args, options in missing:
+            pipeline.execute_command(*args, **options)
+        results = pipeline.execute(raise_on_error=False)
+    for result in results:
+        if isinstance(result, redis.ResponseError):
+            raise result
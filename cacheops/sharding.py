@@ -1,11 +1,40 @@
+from bisect import bisect
 from funcy import cached_property
 from django.core.exceptions import ImproperlyConfigured
 
 from .conf import settings
+from .cross import md5hex
 
 
 def get_prefix(**kwargs):
-    return settings.CACHEOPS_PREFIX(PrefixQuery(**kwargs))
+    prefix = settings.CACHEOPS_PREFIX(PrefixQuery(**kwargs))
+    return hash_tagged(prefix) if settings.CACHEOPS_CLUSTER else prefix
+
+
+def hash_tagged(prefix):
+    """
+    Makes prefix a redis cluster hash tag, so that all keys with it live in a single slot.
+    This way each lua script only touches one slot.
+    """
+    if '{' not in prefix and '}' not in prefix:
+        return '{%s}' % (prefix or 'cacheops')
+    # Respect hash tag set explicitly
+    start = prefix.find('{')
+    end = prefix.find('}', start + 1)
+    if start == -1 or end <= start + 1:
+        raise ImproperlyConfigured('Cacheops prefix %r contains a malformed hash tag' % prefix)
+    return prefix
+
+
+def same_slot_key(key, suffix):
+    """
+    Makes a key for auxiliary data, e.g. a lock, which lives in the same cluster slot as key.
+    """
+    start = key.find('{')
+    if start != -1 and key.find('}', start + 1) > start + 1 or '}' in key:
+        # Either already tagged or can't be wrapped into a tag
+        return key + suffix
+    return '{%s}%s' % (key, suffix)
 
 
 class PrefixQuery(object):
@@ -40,3 +69,22 @@ class PrefixQuery(object):
             tables_str = ', '.join(self.tables)
             raise ImproperlyConfigured('Single table required, but several used: ' + tables_str)
         return self.tables[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes.
+    Adding or removing a node only remaps keys of that node.
+    """
+    def __init__(self, nodes, replicas=160):
+        points = sorted((_hash('%s:%d' % (node, i)), node)
+                        for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key):
+        i = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+def _hash(s):
+    return int(md5hex(s)[:8], 16)
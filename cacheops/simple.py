@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
 import os, time
+import mmap
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import sqlite3
+import threading
+import uuid
+from stat import S_ISREG
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import six
 from .cross import pickle, md5hex
 
-from funcy import wraps
+from funcy import wraps, lcat, chain, ignore
 
 from .conf import settings
-from .utils import func_cache_key, cached_view_fab
-from .redis import redis_client, handle_connection_failure
+from .utils import func_cache_key, func_versions, cached_view_fab
+from .redis import handle_connection_failure, LOCK_TIMEOUT
+from .backends import backend, BackendProxy, BaseBackend, ClientBackend
+from .sharding import same_slot_key
 
 
 __all__ = ('cache', 'cached', 'cached_view', 'file_cache', 'CacheMiss', 'FileCache', 'RedisCache')
@@ -32,32 +47,63 @@ class CacheKey(str):
     def delete(self):
         self.cache.delete(self)
 
+# Results cached with soft_timeout are stored along with the time they need to be refreshed at,
+# a separate type makes them distinguishable from plain results under the same key
+SoftEntry = namedtuple('SoftEntry', 'fresh_until result')
+
+
 class BaseCache(object):
     """
     Simple cache with time-based invalidation
     """
-    def cached(self, timeout=None, extra=None, key_func=func_cache_key):
+    def cached(self, timeout=None, extra=None, key_func=func_cache_key,
+               lock=False, soft_timeout=None, version=None):
         """
-        A decorator for caching function calls
+        A decorator for caching function calls.
+        With lock=True only one caller calculates missing result, others wait for it.
+        With soft_timeout results older than that are still served while one caller refreshes them.
+        Results are keyed by version instead of function line if it's passed.
         """
         # Support @cached (without parentheses) form
         if callable(timeout):
-            return self.cached(key_func=key_func)(timeout)
+            return self.cached(key_func=key_func, lock=lock, soft_timeout=soft_timeout,
+                               version=version)(timeout)
 
         def decorator(func):
+            if version is not None:
+                func_versions[func] = version
+
+            def wrap(result):
+                if soft_timeout is None:
+                    return result
+                return SoftEntry(time.time() + soft_timeout, result)
+
+            def matches(data):
+                # Entry could be written by a version of this func with or without soft_timeout
+                return isinstance(data, SoftEntry) == (soft_timeout is not None)
+
+            def calc(cache_key, args, kwargs):
+                result = func(*args, **kwargs)
+                self.set(cache_key, wrap(result), timeout)
+                return result
+
             @wraps(func)
             def wrapper(*args, **kwargs):
                 if not settings.CACHEOPS_ENABLED:
                     return func(*args, **kwargs)
 
                 cache_key = 'c:' + key_func(func, args, kwargs, extra)
-                try:
-                    result = self.get(cache_key)
-                except CacheMiss:
-                    result = func(*args, **kwargs)
-                    self.set(cache_key, result, timeout)
-
-                return result
+                with self.getting(cache_key, lock=lock) as data:
+                    if data is CacheMiss or not matches(data):
+                        return calc(cache_key, args, kwargs)
+                    elif soft_timeout is None:
+                        return data
+
+                if time.time() < data.fresh_until:
+                    return data.result
+                # Serve stale result while someone else is refreshing it
+                with self.try_lock(cache_key) as acquired:
+                    return calc(cache_key, args, kwargs) if acquired else data.result
 
             def invalidate(*args, **kwargs):
                 cache_key = 'c:' + key_func(func, args, kwargs, extra)
@@ -69,25 +115,122 @@ class BaseCache(object):
                 return CacheKey.make(cache_key, cache=self, timeout=timeout)
             wrapper.key = key
 
+            def get_cache_key(*args, **kwargs):
+                return None, 'c:' + key_func(func, args, kwargs, extra)
+            wrapper.cache_key = get_cache_key
+
+            batch_funcs = []
+
+            def many(batch_func):
+                """
+                Registers a function calculating results for a list of args tuples at once.
+                """
+                batch_funcs[:] = [batch_func]
+                return batch_func
+            wrapper.many = many
+
+            def _calc(args_list):
+                if batch_funcs:
+                    return list(batch_funcs[0](args_list))
+                return [func(*args) for args in args_list]
+
+            def map(args_list):
+                """
+                Looks up all the keys at once and calculates and caches only missing results.
+                """
+                args_list = [args if isinstance(args, tuple) else (args,) for args in args_list]
+                if not settings.CACHEOPS_ENABLED:
+                    return _calc(args_list)
+
+                keys = ['c:' + key_func(func, args, {}, extra) for args in args_list]
+                results = {key: data for key, data in self.get_many(keys).items()
+                           if matches(data)}
+                if soft_timeout is not None:
+                    # No one to serve stale results while refreshing, so recalculate them here
+                    now = time.time()
+                    results = {key: entry.result for key, entry in results.items()
+                               if now < entry.fresh_until}
+                missing = OrderedDict((key, args) for key, args in zip(keys, args_list)
+                                      if key not in results)
+                if missing:
+                    calculated = dict(zip(missing, _calc(list(missing.values()))))
+                    self.set_many({key: wrap(result) for key, result in calculated.items()},
+                                  timeout)
+                    results.update(calculated)
+                return [results[key] for key in keys]
+            wrapper.map = map
+
             return wrapper
         return decorator
 
-    def cached_view(self, timeout=None, extra=None):
+    @contextmanager
+    def getting(self, cache_key, lock=False):
+        """
+        Yields cached data or CacheMiss, with lock=True others wait till this one caches.
+        """
+        try:
+            data = self.get(cache_key)
+        except CacheMiss:
+            data = CacheMiss
+        yield data
+
+    @contextmanager
+    def try_lock(self, cache_key):
+        """
+        Yields whether a lock to update cache_key was acquired, doesn't wait for it.
+        """
+        yield True
+
+    def get_many(self, cache_keys):
+        """
+        Returns a dict of found keys and their values.
+        """
+        results = {}
+        for cache_key in cache_keys:
+            try:
+                results[cache_key] = self.get(cache_key)
+            except CacheMiss:
+                pass
+        return results
+
+    def set_many(self, mapping, timeout=None):
+        for cache_key, data in mapping.items():
+            self.set(cache_key, data, timeout)
+
+    def cached_view(self, timeout=None, extra=None, **kwargs):
         if callable(timeout):
             return self.cached_view()(timeout)
-        return cached_view_fab(self.cached)(timeout=timeout, extra=extra)
+        return cached_view_fab(self.cached)(timeout=timeout, extra=extra, **kwargs)
 
 
 class RedisCache(BaseCache):
     def __init__(self, conn):
-        self.conn = conn
+        # Plain redis clients are wrapped to look like a backend
+        self.conn = conn if isinstance(conn, (BaseBackend, BackendProxy)) else ClientBackend(conn)
 
     def get(self, cache_key):
         data = self.conn.get(cache_key)
-        if data is None:
+        # Someone holds a lock calculating this
+        if data is None or data == b'LOCK':
             raise CacheMiss
         return pickle.loads(data)
 
+    @contextmanager
+    def getting(self, cache_key, lock=False):
+        # Simple cache keys are not sharded, so no prefix
+        with self.conn.getting(None, cache_key, lock=lock) as data:
+            yield CacheMiss if data is None or data == b'LOCK' else pickle.loads(data)
+
+    @contextmanager
+    def try_lock(self, cache_key):
+        lock_key = same_slot_key(cache_key, ':refresh')
+        acquired = self.conn.add(lock_key, b'LOCK', LOCK_TIMEOUT)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.delete(lock_key)
+
     @handle_connection_failure
     def set(self, cache_key, data, timeout=None):
         pickled_data = pickle.dumps(data, -1)
@@ -96,11 +239,21 @@ class RedisCache(BaseCache):
         else:
             self.conn.set(cache_key, pickled_data)
 
+    def get_many(self, cache_keys):
+        data = self.conn.get_many(cache_keys) or [None] * len(cache_keys)
+        return {key: pickle.loads(d) for key, d in zip(cache_keys, data)
+                if d is not None and d != b'LOCK'}
+
+    @handle_connection_failure
+    def set_many(self, mapping, timeout=None):
+        self.conn.set_many({key: pickle.dumps(data, -1) for key, data in mapping.items()},
+                           timeout)
+
     @handle_connection_failure
     def delete(self, cache_key):
         self.conn.delete(cache_key)
 
-cache = RedisCache(redis_client)
+cache = RedisCache(backend)
 cached = cache.cached
 cached_view = cache.cached_view
 
@@ -109,11 +262,14 @@ class FileCache(BaseCache):
     """
     A file cache which fixes bugs and misdesign in django default one.
     Uses mtimes in the future to designate expire time. This makes unnecessary
-    reading stale files.
+    reading stale files. Files are written atomically, so concurrent readers never see
+    partial data. If max_size is set least recently used entries are evicted to stay under it.
     """
-    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT):
+    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT, max_size=None):
         self._dir = path
         self._default_timeout = timeout
+        self._max_size = max_size
+        self._index = FileCacheIndex(os.path.join(path, INDEX_NAME)) if max_size else None
 
     def _key_to_filename(self, key):
         """
@@ -125,16 +281,83 @@ class FileCache(BaseCache):
     def get(self, key):
         filename = self._key_to_filename(key)
         try:
-            # Remove file if it's stale
-            if time.time() >= os.stat(filename).st_mtime:
-                self.delete(filename)
-                raise CacheMiss
-
             with open(filename, 'rb') as f:
-                return pickle.load(f)
-        except (IOError, OSError, EOFError, pickle.PickleError):
+                stat = os.fstat(f.fileno())
+                # Remove file if it's stale
+                if time.time() >= stat.st_mtime:
+                    self._remove(filename)
+                    raise CacheMiss
+
+                # Large entries are unpickled right from page cache without copying to a buffer
+                if stat.st_size >= MMAP_THRESHOLD:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        data = pickle.loads(buf if six.PY3 else buf[:])
+                    finally:
+                        buf.close()
+                else:
+                    data = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
             raise CacheMiss
 
+        if self._index:
+            self._index.touch(self._name(filename))
+        return data
+
+    @contextmanager
+    def getting(self, key, lock=False):
+        try:
+            data = self.get(key)
+        except CacheMiss:
+            data = CacheMiss
+        if data is not CacheMiss or not lock:
+            yield data
+            return
+
+        with self._flock(key):
+            # Someone could have cached it while we were waiting for lock
+            try:
+                data = self.get(key)
+            except CacheMiss:
+                data = CacheMiss
+            yield data
+
+    def try_lock(self, key):
+        return self._flock(key, blocking=False)
+
+    @contextmanager
+    def _flock(self, key, blocking=True):
+        filename = self._key_to_filename(key) + LOCK_SUFFIX
+        try:
+            if fcntl is None:
+                raise OSError('No flock() on this platform')
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+        except (IOError, OSError):
+            # Can't lock, calculate without it then
+            yield True
+            return
+
+        try:
+            # Same as redis lock, don't wait forever for a hung or very slow holder
+            deadline = time.time() + LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    if not blocking or time.time() >= deadline:
+                        yield False
+                        return
+                    time.sleep(FLOCK_RETRY_INTERVAL)
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
     def set(self, key, data, timeout=None):
         filename = self._key_to_filename(key)
         dirname = os.path.dirname(filename)
@@ -142,29 +365,264 @@ class FileCache(BaseCache):
         if timeout is None:
             timeout = self._default_timeout
 
+        pickled_data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
         try:
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
+            # Write to a temporary file and rename it over old one, rename is atomic.
+            # NOTE: not using mkstemp() as it makes files readable by owner only,
+            #       os.open() applies umask to mode same as open() does.
+            tmp_filename = os.path.join(dirname, TMP_PREFIX + uuid.uuid4().hex)
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY, 0o666)
+        except (IOError, OSError):
+            return
 
-            # Use open with exclusive rights to prevent data corruption
-            f = os.open(filename, os.O_EXCL | os.O_WRONLY | os.O_CREAT)
-            try:
-                os.write(f, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
-            finally:
-                os.close(f)
-
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pickled_data)
             # Set mtime to expire time
-            os.utime(filename, (0, time.time() + timeout))
+            os.utime(tmp_filename, (0, time.time() + timeout))
+            replace_file(tmp_filename, filename)
         except (IOError, OSError):
-            pass
+            self._remove(tmp_filename)
+            return
+
+        if self._index:
+            self._index.add(self._name(filename), len(pickled_data))
+            if self._index.total_size() > self._max_size:
+                self._evict()
 
-    def delete(self, fname):
+    def delete(self, key):
+        self._remove(self._key_to_filename(key))
+
+    def _remove(self, filename):
         try:
-            os.remove(fname)
+            os.remove(filename)
             # Trying to remove directory in case it's empty
-            dirname = os.path.dirname(fname)
+            dirname = os.path.dirname(filename)
             os.rmdir(dirname)
         except (IOError, OSError):
             pass
+        if self._index:
+            self._index.discard([self._name(filename)])
 
-file_cache = FileCache(settings.FILE_CACHE_DIR)
+    def clean(self, max_size=None, dry_run=False, workers=4):
+        """
+        Removes expired entries, then ones expiring soonest to fit into max_size bytes.
+        Shard dirs are processed by several threads. Returns stats.
+        """
+        now = time.time()
+        try:
+            shards = [os.path.join(self._dir, name) for name in os.listdir(self._dir)
+                      if os.path.isdir(os.path.join(self._dir, name))]
+        except OSError:
+            shards = []
+
+        def scan(shard):
+            expired, live = [], []
+            for name, stat in _scan_files(shard):
+                path = os.path.join(shard, name)
+                if name.startswith(TMP_PREFIX) or name.endswith(LOCK_SUFFIX):
+                    # Leftovers of crashed writes and old locks, fresh ones could be still in use
+                    if now - stat.st_ctime > TMP_MAX_AGE:
+                        expired.append((path, stat.st_size))
+                elif stat.st_mtime <= now:
+                    expired.append((path, stat.st_size))
+                else:
+                    live.append((stat.st_mtime, stat.st_size, path))
+            if not dry_run:
+                for path, _ in expired:
+                    _remove_file(path)
+            return expired, live
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(scan, shards)
+            expired = lcat(e for e, _ in results)
+            live = sorted(lcat(entries for _, entries in results))
+
+            evicted = []
+            if max_size is not None:
+                size = sum(entry_size for _, entry_size, _ in live)
+                for _, entry_size, path in live:
+                    if size <= max_size:
+                        break
+                    evicted.append((path, entry_size))
+                    size -= entry_size
+                live = live[len(evicted):]
+                if not dry_run:
+                    pool.map(_remove_file, [path for path, _ in evicted])
+        finally:
+            pool.close()
+
+        if not dry_run:
+            for shard in shards:
+                try:
+                    os.rmdir(shard)
+                except OSError:
+                    pass
+            removed = [self._name(path) for path, _ in chain(expired, evicted)]
+            if removed and os.path.exists(os.path.join(self._dir, INDEX_NAME)):
+                FileCacheIndex(os.path.join(self._dir, INDEX_NAME)).discard(removed)
+
+        return {
+            'expired': len(expired),
+            'evicted': len(evicted),
+            'freed': sum(size for _, size in chain(expired, evicted)),
+            'files': len(live),
+            'size': sum(entry_size for _, entry_size, _ in live),
+        }
+
+    def _name(self, filename):
+        return os.path.relpath(filename, self._dir)
+
+    def _evict(self):
+        # Go a bit lower than max size to not evict on each write
+        target = self._max_size * EVICT_TO
+        excess = self._index.total_size() - target
+        while excess > 0:
+            entries = self._index.oldest(EVICT_BATCH)
+            if not entries:
+                break
+            for name, size in entries:
+                self._remove(os.path.join(self._dir, name))
+                excess -= size
+                if excess <= 0:
+                    break
+
+
+MMAP_THRESHOLD = 1024 * 1024
+TMP_PREFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+INDEX_NAME = 'index.sqlite'
+EVICT_TO = 0.9
+EVICT_BATCH = 100
+ACCESS_BATCH = 100
+FLOCK_RETRY_INTERVAL = 0.05
+
+# Python 2 has no os.replace(), rename overwrites files on posix there
+replace_file = getattr(os, 'replace', os.rename)
+
+# Windows would translate newlines without it
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+TMP_MAX_AGE = 60 * 60
+
+def _scan_files(dirname):
+    """
+    Yields (name, stat) pairs for files in dir, uses faster scandir() when available.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(dirname):
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    yield entry.name, entry.stat(follow_symlinks=False)
+            except OSError:
+                pass
+    else:
+        for name in os.listdir(dirname):
+            try:
+                stat = os.lstat(os.path.join(dirname, name))
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode):
+                yield name, stat
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# A locked, read-only or corrupt index shouldn't break cache, it just stops limiting its size
+INDEX_ERRORS = (sqlite3.Error, OSError)
+
+
+class FileCacheIndex(object):
+    """
+    Sizes and access times of file cache entries, kept in sqlite to be shared by processes.
+    Accesses are collected in memory and written in batches.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._accessed = {}
+
+    @property
+    def _conn(self):
+        # sqlite connections can't be shared by threads and shouldn't be used after fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            dirname = os.path.dirname(self._filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self._filename, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                conn.executescript(INDEX_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @ignore(INDEX_ERRORS)
+    def add(self, name, size):
+        self.flush()
+        now = time.time()
+        with self._conn as conn:
+            cursor = conn.execute('UPDATE entries SET size = ?, atime = ? WHERE name = ?',
+                                  (size, now, name))
+            if not cursor.rowcount:
+                conn.execute('INSERT INTO entries VALUES (?, ?, ?)', (name, size, now))
+
+    def touch(self, name):
+        with self._lock:
+            self._accessed[name] = time.time()
+            full = len(self._accessed) >= ACCESS_BATCH
+        if full:
+            self.flush()
+
+    @ignore(INDEX_ERRORS)
+    def flush(self):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            with self._conn as conn:
+                conn.executemany('UPDATE entries SET atime = ? WHERE name = ?',
+                                 [(atime, name) for name, atime in accessed.items()])
+
+    @ignore(INDEX_ERRORS)
+    def discard(self, names):
+        with self._conn as conn:
+            conn.executemany('DELETE FROM entries WHERE name = ?', [(name,) for name in names])
+
+    @ignore(INDEX_ERRORS, default=0)
+    def total_size(self):
+        return self._conn.execute('SELECT size FROM total').fetchone()[0]
+
+    @ignore(INDEX_ERRORS, default=())
+    def oldest(self, count):
+        self.flush()
+        return self._conn.execute('SELECT name, size FROM entries ORDER BY atime LIMIT ?',
+                                  (count,)).fetchall()
+
+
+# Total size is kept up to date by triggers, so that we don't need to sum all the entries
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, size INTEGER, atime REAL);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE TABLE IF NOT EXISTS total (size INTEGER);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE total SET size = size + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE total SET size = size + NEW.size - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE total SET size = size - OLD.size;
+END;
+"""
+
+file_cache = FileCache(settings.FILE_CACHE_DIR, max_size=settings.FILE_CACHE_MAX_SIZE)
@@ -23,9 +23,11 @@ if django.VERSION >= (2, 0):
         return _parse_bits(parser, bits, params, varargs, varkw, defaults, (), (),
                            takes_context=takes_context, name=name)
 
-from django.template import Library
+from django.template import Library, Node
+from django.template.base import Variable
 
 import cacheops
+from cacheops.backends import backend
 from cacheops.utils import carefully_strip_whitespace
 
 
@@ -64,10 +66,47 @@ class CachedNode(TagHelperNode):
 
     def render(self, context):
         args, kwargs = self.get_resolved_arguments(context)
+        # Reuse function decorated while prefetching if args are still the same
+        prepared = context.render_context.get(self)
+        if prepared is not None and prepared[0] == (args, kwargs):
+            return prepared[1]()
         decorator = self.func(*args, **kwargs)
         render = _make_render(context, self.nodelist)
         return decorator(render)()
 
+    def is_static(self, context):
+        """
+        Tells whether args only depend on context variables, which are set already,
+        and not on loop variables and such.
+        """
+        def is_set(expr):
+            var = expr.var
+            return not isinstance(var, Variable) or var.lookups is None or var.lookups[0] in context
+
+        return all(is_set(expr) for expr in self.args + list(self.kwargs.values()))
+
+    def prefetch_key(self, context):
+        """
+        Decorates render function for current context, returns its (prefix, cache key).
+        """
+        args, kwargs = self.get_resolved_arguments(context)
+        cached_render = self.func(*args, **kwargs)(_make_render(context, self.nodelist))
+        if not hasattr(cached_render, 'cache_key'):
+            return None
+        context.render_context[self] = ((args, kwargs), cached_render)
+        return cached_render.cache_key()
+
+
+class PrefetchNode(Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        nodes = [node for node in _cached_nodes(self.nodelist) if node.is_static(context)]
+        keys = [key for key in (node.prefetch_key(context) for node in nodes) if key]
+        with backend.prefetching(keys):
+            return self.nodelist.render(context)
+
 
 def _make_render(context, nodelist):
     def render():
@@ -75,6 +114,18 @@ def _make_render(context, nodelist):
         return carefully_strip_whitespace(nodelist.render(context))
     return render
 
+def _cached_nodes(nodelist):
+    """
+    Finds cached nodes, but not ones nested in them, those won't render on hit anyway.
+    """
+    for node in nodelist:
+        if isinstance(node, CachedNode):
+            yield node
+        else:
+            for attr in node.child_nodelists:
+                for child in _cached_nodes(getattr(node, attr, None) or ()):
+                    yield child
+
 
 @register.decorator_tag
 def cached(timeout, fragment_name, *extra):
@@ -89,3 +140,13 @@ def invalidate_fragment(fragment_name, *extra):
 @register.decorator_tag
 def cached_as(queryset, timeout, fragment_name, *extra):
     return cacheops.cached_as(queryset, timeout=timeout, extra=(fragment_name,) + extra)
+
+
+@register.tag
+def prefetch_cached(parser, token):
+    """
+    Fetches all cached fragments inside with their keys known beforehand in a single request.
+    """
+    nodelist = parser.parse(('endprefetch_cached',))
+    parser.delete_first_token()
+    return PrefetchNode(nodelist)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import re
+import json
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import six
 from django.db import DEFAULT_DB_ALIAS
@@ -14,6 +16,7 @@ except ImportError:
 from funcy import once, decorator
 
 from .utils import monkey_mix
+from .redis import batched_scripts
 
 
 __all__ = ('queue_when_in_transaction', 'install_cacheops_transaction_support',
@@ -22,30 +25,64 @@ __all__ = ('queue_when_in_transaction', 'install_cacheops_transaction_support',
 
 class TransactionState(list):
     def begin(self):
-        self.append({'cbs': [], 'dirty': False})
+        self.append({'cbs': OrderedDict(), 'dirty': set(), 'reads': {}})
 
     def commit(self):
         context = self.pop()
         if self:
             # savepoint
-            self[-1]['cbs'].extend(context['cbs'])
-            self[-1]['dirty'] = self[-1]['dirty'] or context['dirty']
+            for key, call in context['cbs'].items():
+                self[-1]['cbs'].setdefault(key, call)
+            self[-1]['dirty'] |= context['dirty']
+            self[-1]['reads'].update(context['reads'])
         else:
             # transaction
-            for func, args, kwargs in context['cbs']:
-                func(*args, **kwargs)
+            with batched_scripts():
+                for call in context['cbs'].values():
+                    call()
 
     def rollback(self):
         self.pop()
 
-    def push(self, item):
-        self[-1]['cbs'].append(item)
+    def push(self, call):
+        # Identical calls are only made once on commit
+        self[-1]['cbs'].setdefault(call_key(call), call)
+
+    def mark_dirty(self, tables=None):
+        # None stands for unknown tables, which makes everything dirty
+        if tables is not None:
+            tables = {table.lower() for table in tables}
+        self[-1]['dirty'].update([None] if tables is None else tables)
+        self.forget_reads(tables)
+
+    def is_dirty(self, tables=None):
+        """
+        Tells whether any of given tables were written in this transaction,
+        when tables are None tells if anything was written.
+        """
+        for context in self:
+            dirty = context['dirty']
+            if dirty and (tables is None or None in dirty or not dirty.isdisjoint(tables)):
+                return True
+        return False
+
+    # Transaction local read cache, see CACHEOPS_TRANSACTION_CACHE
+    def get_read(self, key):
+        for context in reversed(self):
+            if key in context['reads']:
+                return context['reads'][key][1]
+
+    def set_read(self, key, tables, data):
+        self[-1]['reads'][key] = (tables, data)
 
-    def mark_dirty(self):
-        self[-1]['dirty'] = True
+    def forget_reads(self, tables=None):
+        def stale(read_tables):
+            return tables is None or read_tables is None or not read_tables.isdisjoint(tables)
 
-    def is_dirty(self):
-        return any(context['dirty'] for context in self)
+        for context in self:
+            if context['reads']:
+                context['reads'] = {key: read for key, read in context['reads'].items()
+                                    if not stale(read[0])}
 
 class TransactionStates(threading.local):
     def __init__(self):
@@ -55,16 +92,24 @@ class TransactionStates(threading.local):
     def __getitem__(self, key):
         return self._states[key or DEFAULT_DB_ALIAS]
 
-    def is_dirty(self, dbs):
-        return any(self[db].is_dirty() for db in dbs)
+    def is_dirty(self, dbs, tables=None):
+        return any(self[db].is_dirty(tables) for db in dbs)
 
 transaction_states = TransactionStates()
 
 
+def call_key(call):
+    # NOTE: we use json to compare dict args by value, if that fails call is left unique
+    try:
+        return call._func, json.dumps([call._args, call._kwargs], sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        return call
+
+
 @decorator
 def queue_when_in_transaction(call):
     if transaction_states[call.using]:
-        transaction_states[call.using].push((call, (), {}))
+        transaction_states[call.using].push(call)
     else:
         return call()
 
@@ -97,35 +142,98 @@ class CursorWrapperMixin(object):
 
     def execute(self, sql, params=None):
         result = self._no_monkey.execute(self, sql, params)
-        if transaction_states[self.db.alias] and is_sql_dirty(sql):
-            transaction_states[self.db.alias].mark_dirty()
+        if transaction_states[self.db.alias]:
+            self._mark_sql_dirty(sql)
         return result
 
     def executemany(self, sql, param_list):
         result = self._no_monkey.executemany(self, sql, param_list)
-        if transaction_states[self.db.alias] and is_sql_dirty(sql):
-            transaction_states[self.db.alias].mark_dirty()
+        if transaction_states[self.db.alias]:
+            self._mark_sql_dirty(sql)
         return result
 
+    def _mark_sql_dirty(self, sql):
+        dirty, tables = classify_sql(sql)
+        if dirty:
+            transaction_states[self.db.alias].mark_dirty(tables)
 
-CHARS = set('abcdefghijklmnoprqstuvwxyz_')
 
-def is_sql_dirty(sql):
+def classify_sql(sql):
+    """
+    Tells whether sql writes anything and which tables it writes.
+    Returns a pair (dirty, tables), tables are None when they can't be told.
+    """
     # This should not happen as using bytes in Python 3 is against db protocol,
     # but some people will pass it anyway
     if six.PY3 and isinstance(sql, six.binary_type):
         sql = sql.decode()
+    return _classify_sql(sql)
+
+def is_sql_dirty(sql):
+    return classify_sql(sql)[0]
+
+
+CLEAN = (False, frozenset())
+UNKNOWN = (True, None)
+
+FIRST_WORD_RE = re.compile(r'\s*([a-zA-Z]+)')
+WRITE_RE = re.compile(r'''
+    \s*(?:
+        insert\s+(?:ignore\s+|or\s+\w+\s+)?into
+        |replace\s+into
+        |update
+        |delete\s+from
+    )\s+([`"]?)([\w$]+)\1(?=[\s(]|$)
+''', re.I | re.X)
+# Multi-table UPDATE a JOIN b ... or UPDATE a, b ... in MySQL could write any of them
+UPDATE_SET_RE = re.compile(r'\s+set\b', re.I)
+LOCK_RE = re.compile(r'\bfor\s+(?:no\s+key\s+)?update\b', re.I)
+CLEAN_WORDS = {'savepoint', 'release', 'rollback', 'set', 'show'}
+# Things like UPDATE ONLY or DELETE QUICK FROM which we don't bother to parse
+MODIFIER_WORDS = {'only', 'ignore', 'low_priority', 'high_priority', 'delayed', 'quick'}
+
+def _classify_sql(sql):
+    # Several statements could be passed at once, can only scan them for keywords
+    p = sql.find(';')
+    if p != -1 and sql[p + 1:].strip():
+        return UNKNOWN if _has_write_keywords(sql) else CLEAN
+
+    # NOTE: look at the statement prefix only, sql could be very long
+    match = FIRST_WORD_RE.match(sql)
+    word = match.group(1).lower() if match else None
+
+    if word == 'select':
+        # SELECT ... FOR UPDATE is conservatively treated as a write,
+        # substring check first since regex search is way slower
+        return UNKNOWN if 'update' in sql.lower() and LOCK_RE.search(sql) else CLEAN
+    elif word in ('insert', 'update', 'delete', 'replace'):
+        match = WRITE_RE.match(sql)
+        if not match \
+                or not match.group(1) and match.group(2).lower() in MODIFIER_WORDS \
+                or word == 'update' and not UPDATE_SET_RE.match(sql, match.end()):
+            return UNKNOWN
+        return True, frozenset([match.group(2)])
+    elif word in CLEAN_WORDS:
+        return CLEAN
+    else:
+        # Something unusual like WITH or EXPLAIN, fall back to keyword scan
+        return UNKNOWN if _has_write_keywords(sql) else CLEAN
+
+
+CHARS = set('abcdefghijklmnoprqstuvwxyz_')
+
+def _has_write_keywords(sql):
     # NOTE: not using regex here for speed
     sql = sql.lower()
     for action in ('update', 'insert', 'delete'):
         p = sql.find(action)
-        if p == -1:
-            continue
-        start, end = p - 1, p + len(action)
-        if (start < 0 or sql[start] not in CHARS) and (end >= len(sql) or sql[end] not in CHARS):
-            return True
-    else:
-        return False
+        while p != -1:
+            start, end = p - 1, p + len(action)
+            if (start < 0 or sql[start] not in CHARS) \
+                    and (end >= len(sql) or sql[end] not in CHARS):
+                return True
+            p = sql.find(action, end)
+    return False
 
 
 @once
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple
 from itertools import product
-from funcy import group_by, join_with
+from funcy import group_by, join_with, memoize
 from funcy.py3 import lcat, lmap
 
 import django
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models.query import QuerySet
 from django.db.models.sql import OR
+from django.db.models.sql.constants import LOUTER
 from django.db.models.sql.query import Query, ExtraWhere
 from django.db.models.sql.where import NothingNode, SubqueryConstraint
-from django.db.models.lookups import Lookup, Exact, In, IsNull
+from django.utils.tree import Node
+from django.db.models.lookups import Lookup, Exact, In, IsNull, \
+    GreaterThan, GreaterThanOrEqual, LessThan, LessThanOrEqual, Range as RangeLookup
 # This thing existed in Django 1.8 and earlier
 try:
     from django.db.models.sql.where import EverythingNode
@@ -27,10 +32,86 @@ except ImportError:
     class RawSQL(object):
         pass
 
-from .utils import NOT_SERIALIZED_FIELDS
+from .utils import NOT_SERIALIZED_FIELDS, range_index_fields, range_score
 
 
 LONG_DISJUNCTION = 8
+MAX_IN_SET = 10000
+
+
+class Range(namedtuple('Range', 'lo hi')):
+    """
+    A closed range of scores, None means unbounded.
+    Serialized as a list, which distinguishes it from eq conditions in conj.
+    """
+    __slots__ = ()
+
+    def __and__(self, other):
+        los = [lo for lo in (self.lo, other.lo) if lo is not None]
+        his = [hi for hi in (self.hi, other.hi) if hi is not None]
+        return Range(max(los) if los else None, min(his) if his else None)
+
+    def is_empty(self):
+        return None not in self and self.lo > self.hi
+
+class InSet(dict):
+    """
+    A long __in list, stored as a single set in redis instead of a conj per value.
+    Serialized as {"in": [...]} not to be confused with eq or range conds.
+    """
+    def __init__(self, values):
+        dict.__init__(self, {'in': list(values)})
+
+    def __and__(self, other):
+        other_values = set(other['in'])
+        return InSet(v for v in self['in'] if v in other_values)
+
+    def is_empty(self):
+        return not self['in']
+
+def lookup_range(lookup):
+    """
+    Converts range/comparison lookup to a Range, strictness is ignored.
+    """
+    if isinstance(lookup, (GreaterThan, GreaterThanOrEqual)):
+        return Range(range_score(lookup.rhs), None)
+    elif isinstance(lookup, (LessThan, LessThanOrEqual)):
+        return Range(None, range_score(lookup.rhs))
+    elif isinstance(lookup, RangeLookup):
+        lo, hi = lookup.rhs
+        return Range(range_score(lo), range_score(hi))
+
+
+@memoize
+def column_attnames(model):
+    return {f.column: f.attname for f in model._meta.local_concrete_fields}
+
+def join_pairs(query):
+    """
+    Returns pairs of (alias, attname) known to be equal by join conditions.
+    """
+    pairs = []
+    for alias, join in query.alias_map.items():
+        # Skip base table and unreferenced joins
+        join_cols = getattr(join, 'join_cols', None)
+        if not join_cols or not query.alias_refcount[alias]:
+            continue
+        # Outer joins produce rows with NULLs in joined columns, which are not equal to anything.
+        # Nullable joins are promoted to outer ones when these NULLs could matter.
+        if join.join_type == LOUTER:
+            continue
+        # join_field is either a forward field or a reverse relation,
+        # in both cases .model is on parent side and .related_model is on joined one
+        try:
+            parent_attnames = column_attnames(join.join_field.model)
+            child_attnames = column_attnames(join.join_field.related_model)
+        except AttributeError:
+            continue
+        for parent_col, child_col in join_cols:
+            if parent_col in parent_attnames and child_col in child_attnames:
+                pairs.append(((join.parent_alias, parent_attnames[parent_col]),
+                              (alias, child_attnames[child_col])))
+    return pairs
 
 
 def dnfs(qs):
@@ -40,7 +121,9 @@ def dnfs(qs):
 
     Any negations, conditions with lookups other than __exact or __in,
     conditions on joined models and subrequests are ignored.
-    __in is converted into = or = or = ...
+    __in is converted into = or = or = ..., long __in into InSet cond.
+    Comparisons and __range on fields with range index are converted into Range conds.
+    Eq and __in conds are propagated to joined aliases through join columns.
     """
     SOME = object()
     SOME_TREE = [[(None, None, SOME, True)]]
@@ -70,11 +153,24 @@ def dnfs(qs):
 
             attname = where.lhs.target.attname
             if isinstance(where, Exact):
+                # Lists and dicts could not be serialized into conj key
+                if isinstance(where.rhs, (list, tuple, dict)):
+                    return SOME_TREE
                 return [[(where.lhs.alias, attname, where.rhs, True)]]
             elif isinstance(where, IsNull):
                 return [[(where.lhs.alias, attname, None, where.rhs)]]
             elif isinstance(where, In) and len(where.rhs) < LONG_DISJUNCTION:
                 return [[(where.lhs.alias, attname, v, True)] for v in where.rhs]
+            elif isinstance(where, In) and len(where.rhs) <= MAX_IN_SET:
+                return [[(where.lhs.alias, attname, InSet(where.rhs), True)]]
+            elif attname in range_index_fields(where.lhs.target.model._meta.concrete_model):
+                try:
+                    rng = lookup_range(where)
+                except (TypeError, ValueError):
+                    return SOME_TREE
+                if rng is None:
+                    return SOME_TREE
+                return [[(where.lhs.alias, attname, rng, True)]]
             else:
                 return SOME_TREE
         elif isinstance(where, EverythingNode):
@@ -106,15 +202,57 @@ def dnfs(qs):
 
             return result
 
+    def propagate_conj(conj, pairs):
+        """
+        Adds conds implied by join conditions, e.g. post.category_id = 1 on a join
+        with category.id = post.category_id gives category.id = 1.
+        """
+        # NOTE: ranges are not propagated since joined field might not have range index,
+        #       IS NULL conds are not since NULL is not equal to NULL in a join.
+        def propagated(value):
+            return value is not SOME and value is not None and not isinstance(value, Range)
+
+        known = {(alias, attname): value for alias, attname, value, negation in conj
+                 if negation and propagated(value)}
+        if not known:
+            return conj
+
+        conj = conj[:]
+        changed = True
+        while changed:
+            changed = False
+            for pair in pairs:
+                for src, dst in (pair, pair[::-1]):
+                    if src in known and dst not in known:
+                        known[dst] = known[src]
+                        conj.append(dst + (known[src], True))
+                        changed = True
+        return conj
+
     def clean_conj(conj, for_alias):
-        conds = {}
+        conds, in_sets, ranges = {}, {}, {}
         for alias, attname, value, negation in conj:
             # "SOME" conds, negated conds and conds for other aliases should be stripped
             if value is not SOME and negation and alias == for_alias:
+                if isinstance(value, (InSet, Range)):
+                    special = in_sets if isinstance(value, InSet) else ranges
+                    # Conjs with non-intersecting sets or ranges will never cause invalidation
+                    value = special[attname] & value if attname in special else value
+                    if value.is_empty():
+                        return None
+                    special[attname] = value
+                    continue
                 # Conjs with fields eq 2 different values will never cause invalidation
                 if attname in conds and conds[attname] != value:
                     return None
                 conds[attname] = value
+        # Only a single non-eq cond is indexed per conj, preferring more specific ones
+        for special in (in_sets, ranges):
+            special = {attname: v for attname, v in special.items() if attname not in conds}
+            if special:
+                attname = min(special)
+                conds[attname] = special[attname]
+                break
         return conds
 
     def clean_dnf(tree, aliases):
@@ -135,6 +273,9 @@ def dnfs(qs):
             return query.alias_map[alias].table_name
 
         dnf = _dnf(query.where)
+        pairs = join_pairs(query)
+        if pairs:
+            dnf = [propagate_conj(conj, pairs) for conj in dnf]
 
         # NOTE: we exclude content_type as it never changes and will hold dead invalidation info
         main_alias = query.model._meta.db_table
@@ -148,3 +289,60 @@ def dnfs(qs):
         return join_with(lcat, (query_dnf(q) for q in qs.query.combined_queries))
     else:
         return query_dnf(qs.query)
+
+
+def query_tables(qs):
+    """
+    Returns a set of tables queryset results depend on,
+    None if these can't be told, e.g. there are subqueries or extra sql.
+    """
+    def opaque(node):
+        if isinstance(node, (QuerySet, Query, Subquery, RawSQL, ExtraWhere, SubqueryConstraint)):
+            return True
+        elif isinstance(node, Node):
+            children = node.children
+        elif isinstance(node, Lookup):
+            children = [node.lhs, node.rhs]
+        elif hasattr(node, 'get_source_expressions'):
+            children = node.get_source_expressions()
+        else:
+            return False
+        return any(opaque(child) for child in children)
+
+    def model_tables(model):
+        # Multi-table inheritance parents are joined at compile time
+        return {m._meta.db_table for m in [model] + list(model._meta.get_parent_list())}
+
+    def related_tables(model, select_related):
+        # select_related() without fields follows all non-null foreign keys, not worth repeating
+        if select_related is True:
+            return None
+        result = set()
+        for name, nested in select_related.items():
+            try:
+                related = model._meta.get_field(name).related_model
+            except FieldDoesNotExist:
+                return None
+            nested_tables = related_tables(related, nested)
+            if nested_tables is None:
+                return None
+            result |= model_tables(related) | nested_tables
+        return result
+
+    def tables(query):
+        if query.extra or query.extra_tables \
+                or opaque(query.where) or any(map(opaque, query.annotations.values())):
+            return None
+        result = {join.table_name for alias, join in query.alias_map.items()
+                  if query.alias_refcount[alias]} | model_tables(query.model)
+        if query.select_related:
+            selected = related_tables(query.model, query.select_related)
+            if selected is None:
+                return None
+            result |= selected
+        # Some backends, e.g. Oracle, uppercase table names in sql
+        return {table.lower() for table in result}
+
+    queries = getattr(qs.query, 'combined_queries', None) or [qs.query]
+    results = lmap(tables, queries)
+    return None if None in results else set().union(*results)
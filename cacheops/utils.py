@@ -2,14 +2,26 @@
 import re
 import json
 import inspect
+import calendar
+import hashlib
+import weakref
+import six
+from datetime import date, datetime, time
+from functools import partial
+from decimal import Decimal
 from funcy import memoize, compose, wraps, any, any_fn, select_values
-from funcy.py3 import lmapcat
-from .cross import md5hex
+from funcy.py3 import lmap, lmapcat
+from .cross import md5hex, key_hasher
 
+from django.core.exceptions import ImproperlyConfigured, FieldDoesNotExist
+from django.core.signals import setting_changed
 from django.db import models
-from django.http import HttpRequest
+from django.http import HttpRequest, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.text import compress_string
 
-from .conf import model_profile
+from .conf import model_profile, settings
 
 
 # NOTE: we don't serialize this fields since their values could be very long
@@ -70,6 +82,60 @@ def monkey_mix(cls, mixin):
         setattr(cls, name, method)
 
 
+### Range indexes
+
+RANGE_INDEX_FIELDS = (
+    models.AutoField,
+    models.IntegerField,
+    models.FloatField,
+    models.DecimalField,
+    models.DateField,  # DateTimeField is a subclass
+    models.TimeField,
+)
+
+@memoize
+def range_index_fields(model):
+    """
+    Returns a set of attnames of model fields having range index.
+    """
+    profile = model_profile(model)
+    if not profile or not profile['range_index']:
+        return frozenset()
+
+    attnames = set()
+    for name in profile['range_index']:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured('Unknown range_index field %s.%s.%s'
+                                       % (model._meta.app_label, model._meta.model_name, name))
+        if not isinstance(field, RANGE_INDEX_FIELDS):
+            raise ImproperlyConfigured('Range index is only supported for numeric and date fields,'
+                                       ' %s.%s.%s is neither'
+                                       % (model._meta.app_label, model._meta.model_name, name))
+        attnames.add(field.attname)
+    return frozenset(attnames)
+
+def range_score(value):
+    """
+    Converts a value to a float score to be used in redis sorted set.
+    Conversion is monotonic, which is all we need to test range inclusion.
+    """
+    if isinstance(value, bool):
+        raise TypeError("Can't score a boolean")
+    elif isinstance(value, six.integer_types + (float, Decimal)):
+        return float(value)
+    elif isinstance(value, datetime):
+        # Naive datetimes are treated as UTC, which is fine as long as all of them are naive
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    elif isinstance(value, date):
+        return float(calendar.timegm(value.timetuple()))
+    elif isinstance(value, time):
+        return value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6
+    else:
+        raise TypeError("Can't score %r" % value)
+
+
 @memoize
 def stamp_fields(model):
     """
@@ -88,28 +154,153 @@ def obj_key(obj):
         factors = [obj.__module__, obj.__name__]
         # Really useful to ignore this while code still in development
         if hasattr(obj, '__code__') and not obj.__globals__.get('CACHEOPS_DEBUG'):
-            factors.append(obj.__code__.co_firstlineno)
+            factors.append(func_identity(obj))
         return factors
     else:
         return str(obj)
 
+# Explicit versions passed to decorators, these replace line or code identity
+func_versions = weakref.WeakKeyDictionary()
+
+def func_identity(func):
+    """
+    Returns what distinguishes func from other functions with same name
+    and changes when it changes.
+    """
+    version = func_versions.get(func)
+    if version is not None:
+        return 'v:%s' % version
+    elif settings.CACHEOPS_FUNC_IDENTITY == 'code':
+        identity = code_hash(func.__code__)
+        # Changed defaults change results same as changed code does
+        defaults = func.__defaults__, getattr(func, '__kwdefaults__', None)
+        if any(defaults):
+            identity += ':' + md5hex(json.dumps(defaults, sort_keys=True, default=obj_key))
+        return identity
+    else:
+        return func.__code__.co_firstlineno
+
+# Weak keys not to pin code of lambdas and other functions created on the fly
+_code_hashes = weakref.WeakKeyDictionary()
+
+def code_hash(code):
+    """
+    Hashes bytecode, names and constants, which unlike line numbers survive unrelated edits.
+    """
+    try:
+        return _code_hashes[code]
+    except KeyError:
+        digest = _code_hashes[code] = _code_hash(code)
+        return digest
+
+def _code_hash(code):
+    hasher = key_hasher(code.co_code)
+    hasher.update(repr(code.co_names).encode('utf-8'))
+    hasher.update(repr(lmap(_const_key, code.co_consts)).encode('utf-8'))
+    return hasher.hexdigest()
+
+def _const_key(const):
+    # Code reprs contain addresses and frozensets are unordered
+    if inspect.iscode(const):
+        return code_hash(const)
+    elif isinstance(const, frozenset):
+        return sorted(map(_const_key, const))
+    elif isinstance(const, tuple):
+        return lmap(_const_key, const)
+    else:
+        return repr(const)
+
+# Reprs of these are unambiguous and fast, models are replaced with obj_key() strings.
+# Python 2 str and unicode reprs differ though, so strings go through json there.
+SIMPLE_ARG_TYPES = six.integer_types + (float, type(None), models.Model) \
+    + (() if six.PY2 else (str,))
+
+_func_hashers = weakref.WeakKeyDictionary()
+# Decorated functions pass the same extra object on each call, so hashers fed with it are kept too
+_extra_hashers = weakref.WeakKeyDictionary()
+
+def _clear_func_hashers(setting, **kwargs):
+    if setting == 'CACHEOPS_FUNC_IDENTITY':
+        _func_hashers.clear()
+        _extra_hashers.clear()
+setting_changed.connect(_clear_func_hashers, weak=False)
+
+def func_hasher(func, extra=None):
+    """
+    Returns a hasher already fed with func identity and extra, to be copied for each call.
+    """
+    try:
+        if extra is None:
+            return _func_hashers[func]
+        hashed_extra, hasher = _extra_hashers[func]
+        if hashed_extra is extra:
+            return hasher
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable or not weak referenceable callables
+        return _make_func_hasher(func, extra)
+
+    hasher = _make_func_hasher(func, extra)
+    if extra is None:
+        _func_hashers[func] = hasher
+    else:
+        _extra_hashers[func] = (extra, hasher)
+    return hasher
+
+def _make_func_hasher(func, extra=None):
+    data = json.dumps(func, default=obj_key)
+    if extra is not None:
+        # Neither json nor reprs have raw newlines, so this can't mix with call data
+        data += '\n' + json.dumps(extra, sort_keys=True, default=obj_key)
+    return key_hasher(data.encode('utf-8'))
+
 def func_cache_key(func, args, kwargs, extra=None):
     """
     Calculate cache key based on func and arguments
     """
+    if settings.CACHEOPS_LEGACY_FUNC_KEYS:
+        return legacy_func_cache_key(func, args, kwargs, extra)
+
+    if not kwargs and all(isinstance(arg, SIMPLE_ARG_TYPES) for arg in args):
+        data = repr(tuple(obj_key(arg) if isinstance(arg, models.Model) else arg
+                          for arg in args))
+    else:
+        data = json.dumps([args, kwargs], sort_keys=True, default=obj_key)
+    hasher = func_hasher(func, extra).copy()
+    hasher.update(data.encode('utf-8'))
+    return hasher.hexdigest()
+
+def legacy_func_cache_key(func, args, kwargs, extra=None):
+    """
+    Calculates keys as cacheops did before, used with CACHEOPS_LEGACY_FUNC_KEYS.
+    """
     factors = [func, args, kwargs, extra]
     return md5hex(json.dumps(factors, sort_keys=True, default=obj_key))
 
-def view_cache_key(func, args, kwargs, extra=None):
+def view_cache_key(func, args, kwargs, extra=None, vary_headers=(), vary_cookies=()):
     """
     Calculate cache key for view func.
     Use url instead of not properly serializable request argument.
     """
     if hasattr(args[0], 'build_absolute_uri'):
         uri = args[0].build_absolute_uri()
+        meta, cookies = args[0].META, args[0].COOKIES
     else:
         uri = args[0]
-    return 'v:' + func_cache_key(func, args[1:], kwargs, extra=(uri, extra))
+        meta, cookies = {}, {}
+    headers = [meta.get(header_meta_key(h)) for h in vary_headers]
+    cookies = [cookies.get(c) for c in vary_cookies]
+    if settings.CACHEOPS_LEGACY_FUNC_KEYS:
+        if vary_headers or vary_cookies:
+            extra = (extra, headers, cookies)
+        return 'v:' + legacy_func_cache_key(func, args[1:], kwargs, extra=(uri, extra))
+    # Request dependent parts go to args, so that static extra is only hashed once
+    args = tuple([uri] + headers + cookies) + tuple(args[1:])
+    return 'v:' + func_cache_key(func, args, kwargs, extra=extra)
+
+def header_meta_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
 
 def cached_view_fab(_cached):
     def force_render(response):
@@ -118,9 +309,38 @@ def cached_view_fab(_cached):
         return response
 
     def cached_view(*dargs, **dkwargs):
+        conditional = dkwargs.pop('conditional', False)
+        gzip = dkwargs.pop('gzip', False)
+        vary_headers = dkwargs.pop('vary_headers', ())
+        vary_cookies = dkwargs.pop('vary_cookies', ())
+        if vary_headers or vary_cookies:
+            key_func = partial(view_cache_key,
+                               vary_headers=vary_headers, vary_cookies=vary_cookies)
+        else:
+            key_func = view_cache_key
+
         def decorator(func):
-            dkwargs['key_func'] = view_cache_key
-            cached_func = _cached(*dargs, **dkwargs)(compose(force_render, func))
+            dkwargs['key_func'] = key_func
+            if not conditional and not gzip:
+                cached_func = _cached(*dargs, **dkwargs)(compose(force_render, func))
+            else:
+                def render(request, *args, **kwargs):
+                    response = force_render(func(request, *args, **kwargs))
+                    if gzip:
+                        compress_response(response)
+                    if conditional and set_validators(response) and hasattr(meta_func, 'key'):
+                        # Time invalidated caches could refresh meta and response independently
+                        meta_func.key(request, *args, **kwargs).set(response_validators(response))
+                    return response
+                cached_func = _cached(*dargs, **dkwargs)(render)
+
+            if conditional:
+                # Validators are stored separately to not fetch and unpickle response for 304
+                def get_meta(request, *args, **kwargs):
+                    return response_validators(cached_func(request, *args, **kwargs))
+                meta_kwargs = dict(dkwargs, key_func=lambda *a: 'meta:' + key_func(*a))
+                meta_kwargs.pop('soft_timeout', None)
+                meta_func = _cached(*dargs, **meta_kwargs)(get_meta)
 
             @wraps(func)
             def wrapper(request, *args, **kwargs):
@@ -129,10 +349,31 @@ def cached_view_fab(_cached):
                 if request.method not in ('GET', 'HEAD'):
                     return func(request, *args, **kwargs)
 
-                return cached_func(request, *args, **kwargs)
+                response = None
+                conditional_get = 'HTTP_IF_NONE_MATCH' in request.META \
+                    or 'HTTP_IF_MODIFIED_SINCE' in request.META
+                if conditional and conditional_get:
+                    validators = meta_func(request, *args, **kwargs)
+                    if validators and not_modified(request, validators):
+                        response = HttpResponseNotModified()
+                        for header, value in validators.items():
+                            response[header] = value
+
+                if response is None:
+                    response = cached_func(request, *args, **kwargs)
+                    if gzip:
+                        response = encode_response(request, response)
+                if vary_headers or vary_cookies:
+                    patch_vary_headers(response,
+                                       list(vary_headers) + (['Cookie'] if vary_cookies else []))
+                return response
 
             if hasattr(cached_func, 'invalidate'):
-                wrapper.invalidate = cached_func.invalidate
+                def invalidate(*args, **kwargs):
+                    cached_func.invalidate(*args, **kwargs)
+                    if conditional:
+                        meta_func.invalidate(*args, **kwargs)
+                wrapper.invalidate = invalidate
                 wrapper.key = cached_func.key
 
             return wrapper
@@ -140,6 +381,76 @@ def cached_view_fab(_cached):
     return cached_view
 
 
+### Conditional GET for cached views
+
+def set_validators(response):
+    """
+    Adds ETag and Last-Modified to a successful response unless it has them already.
+    """
+    if response.status_code != 200 or getattr(response, 'streaming', False):
+        return False
+    if not response.has_header('ETag'):
+        response['ETag'] = '"%s"' % hashlib.md5(response.content).hexdigest()
+    if not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date()
+    return True
+
+# 304 should still tell caches what it varies on and for how long to keep it
+NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Vary', 'Cache-Control')
+
+def response_validators(response):
+    """
+    Returns headers to send with 304 in place of this response, None if it can't be validated.
+    """
+    if response.has_header('ETag') and response.has_header('Last-Modified'):
+        return {header: response[header] for header in NOT_MODIFIED_HEADERS
+                if response.has_header(header)}
+
+def compress_response(response):
+    """
+    Stores gzipped content along with response, so that it's not compressed on each cache hit.
+    Skips same responses GZipMiddleware does.
+    """
+    if response.status_code != 200 or getattr(response, 'streaming', False) \
+            or response.has_header('Content-Encoding') or len(response.content) < 200:
+        return
+    compressed = compress_string(response.content)
+    if len(compressed) < len(response.content):
+        response._gzipped_content = compressed
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+def encode_response(request, response):
+    """
+    Picks gzipped or identity content of a cached response according to Accept-Encoding.
+    """
+    if getattr(response, '_gzipped_content', None) is None:
+        return response
+    if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response.content = response._gzipped_content
+        response['Content-Length'] = str(len(response.content))
+        response['Content-Encoding'] = 'gzip'
+        # Compressed content is not byte for byte the same, same as in GZipMiddleware
+        if response.has_header('ETag') and response['ETag'].startswith('"'):
+            response['ETag'] = 'W/' + response['ETag']
+    return response
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+def not_modified(request, validators):
+    def normalize(tag):
+        return tag.strip().replace('W/', '', 1).strip('"')
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = {normalize(tag) for tag in if_none_match.split(',')}
+        return '*' in tags or normalize(validators['ETag']) in tags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    modified = parse_http_date_safe(validators['Last-Modified'])
+    # Dates are precise to a second, so a change later in the same second would go unnoticed
+    return if_modified_since is not None and modified is not None \
+        and modified <= if_modified_since and modified < parse_http_date_safe(http_date())
+
+
 ### Whitespace handling for template tags
 
 from django.utils.safestring import mark_safe
@@ -2,6 +2,8 @@ from cacheops import invalidate_obj, invalidate_model
 from cacheops.redis import redis_client
 from cacheops.cross import pickle
 from cacheops.tree import dnfs
+from cacheops.transaction import classify_sql, _has_write_keywords
+from cacheops.utils import func_cache_key, legacy_func_cache_key
 
 from .models import Category, Post, Extra
 
@@ -124,6 +126,67 @@ def do_complex_dnfs():
     dnfs(complex_qs)
 
 
+### Joins
+
+join_qs = Category.objects.filter(pk=1, posts__title='Hi', posts__visible=True)
+
+def do_join_dnfs():
+    dnfs(join_qs)
+
+def do_join():
+    list(Category.objects.cache().filter(pk=1, posts__title='Hi', posts__visible=True))
+
+def invalidate_join():
+    redis_client.delete(join_qs._cache_key())
+
+
+### Long __in
+
+long_in_qs = Category.objects.filter(pk__in=range(1000))
+long_in_key = long_in_qs._cache_key()
+
+def invalidate_long_in():
+    redis_client.delete(long_in_key)
+
+def do_long_in():
+    list(Category.objects.cache().filter(pk__in=range(1000)))
+
+
+### SQL classification
+
+long_select = 'SELECT %s FROM "tests_post" WHERE "tests_post"."id" IN (%s)' % (
+    ', '.join('"tests_post"."field_%d"' % i for i in range(100)), ', '.join(['%s'] * 1000))
+long_insert = 'INSERT INTO "tests_post" ("title", "category_id") VALUES %s' \
+    % ', '.join(['(%s, %s)'] * 1000)
+
+def do_classify_select():
+    classify_sql(long_select)
+
+def do_classify_insert():
+    classify_sql(long_insert)
+
+def do_scan_select():
+    _has_write_keywords(long_select)
+
+
+### Function cache keys
+
+def keyed_func(category, page, lang=None):
+    pass
+
+def do_func_cache_key_simple():
+    func_cache_key(keyed_func, (c, 1, 'en'), {})
+
+def do_func_cache_key_legacy_simple():
+    legacy_func_cache_key(keyed_func, (c, 1, 'en'), {})
+
+def do_func_cache_key_kwargs():
+    func_cache_key(keyed_func, (c, 1), {'lang': 'en'})
+
+def do_func_cache_key_legacy_kwargs():
+    legacy_func_cache_key(keyed_func, (c, 1), {'lang': 'en'})
+
+
 ### More invalidation
 
 def prepare_cache():
@@ -193,6 +256,21 @@ TESTS = [
     ('complex_cache_key', {'run': do_complex_cache_key}),
     ('complex_dnfs', {'run': do_complex_dnfs}),
 
+    ('join_dnfs', {'run': do_join_dnfs}),
+    ('join_miss', {'prepare': invalidate_join, 'run': do_join}),
+
+    ('long_in_hit', {'prepare_once': do_long_in, 'run': do_long_in}),
+    ('long_in_miss', {'prepare': invalidate_long_in, 'run': do_long_in}),
+
+    ('classify_select', {'run': do_classify_select}),
+    ('classify_insert', {'run': do_classify_insert}),
+    ('scan_select', {'run': do_scan_select}),
+
+    ('func_cache_key_simple', {'run': do_func_cache_key_simple}),
+    ('func_cache_key_legacy_simple', {'run': do_func_cache_key_legacy_simple}),
+    ('func_cache_key_kwargs', {'run': do_func_cache_key_kwargs}),
+    ('func_cache_key_legacy_kwargs', {'run': do_func_cache_key_legacy_kwargs}),
+
     ('big_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_obj}),
     ('model_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_model}),
 ]
@@ -188,6 +188,13 @@ class CacheOnSaveModel(models.Model):
     title = models.CharField(max_length=32)
 
 
+# range_index
+class Measure(models.Model):
+    value = models.IntegerField()
+    taken = models.DateTimeField(null=True)
+    label = models.CharField(max_length=32, default='')
+
+
 # 47
 class DbAgnostic(models.Model):
     pass
@@ -97,6 +97,7 @@ CACHEOPS = {
     'tests.local': {'local_get': True},
     'tests.cacheonsavemodel': {'cache_on_save': True},
     'tests.dbbinded': {'db_agnostic': False},
+    'tests.measure': {'range_index': ['value', 'taken']},
     'tests.*': {},
     'tests.noncachedvideoproxy': None,
     'tests.noncachedmedia': None,
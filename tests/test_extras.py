@@ -1,13 +1,24 @@
+import time
+import unittest
+import warnings
+import threading
+import mock
+import redis
 from django.db import connections
 from django.test import TestCase
 from django.test import override_settings
 
-from cacheops import cached_as, no_invalidation, invalidate_obj, invalidate_model, invalidate_all
+from cacheops import cached_as, cached, no_invalidation, invalidate_obj, invalidate_model, \
+    invalidate_all
 from cacheops.conf import settings
-from cacheops.signals import cache_read, cache_invalidated
+from cacheops.redis import redis_client, CacheopsRedis, CacheopsRedisMixin, CircuitBreaker, \
+    load_script, preload_scripts, batched_scripts, script_batch, make_client, \
+    CacheopsConnectionPool, _handle_failure, ThreadPoolExecutor
+from cacheops.backends import get_backend, MemoryBackend
+from cacheops.signals import cache_read, cache_invalidated, cache_circuit_changed
 
 from .utils import BaseTestCase, make_inc
-from .models import Post, Category, Local, DbAgnostic, DbBinded
+from .models import Post, Category, Local, DbAgnostic, DbBinded, Measure
 
 
 class SettingsTests(TestCase):
@@ -123,6 +134,461 @@ class LockingTests(BaseTestCase):
         self.assertEqual(results[0], results[1])
 
 
+class ReadBudgetTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _fetch(self):
+        qs = Category.objects.cache()
+        qs._cacheprofile['read_budget'] = 0.05
+        return list(qs)
+
+    def test_in_budget(self):
+        self._fetch()
+        with self.assertNumQueries(0):
+            self._fetch()
+
+    def test_queue_wait(self):
+        self._fetch()
+        # Waiting for a free worker is not counted in budget
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        with mock.patch('cacheops.redis._read_executor', return_value=executor):
+            executor.submit(time.sleep, 0.1)
+            with self.assertNumQueries(0):
+                self._fetch()
+
+    def test_budget_exceeded(self):
+        replica_get = CacheopsRedisMixin.replica_get
+        done = threading.Event()
+
+        def slow_get(self, key):
+            time.sleep(0.2)
+            try:
+                return replica_get(self, key)
+            finally:
+                done.set()
+
+        with mock.patch.object(CacheopsRedisMixin, 'replica_get', slow_get):
+            start = time.time()
+            with self.assertNumQueries(1):
+                self._fetch()
+            self.assertLess(time.time() - start, 0.15)
+
+        # Results are written once slow get misses
+        self.assertTrue(done.wait(1))
+        time.sleep(0.05)
+        with self.assertNumQueries(0):
+            self._fetch()
+
+
+class ReplicaTests(BaseTestCase):
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+        self.client = CacheopsRedis(**settings.CACHEOPS_REDIS)
+        self.replica = CacheopsRedis(**dict(settings.CACHEOPS_REDIS, db=14))
+        self.addCleanup(self.replica.flushdb)
+        self.client.replicas = [self.replica]
+
+        # Make a difference to see where we read from
+        self.client.set('key', 'master')
+        self.replica.set('key', 'replica')
+
+    def test_read_replica(self):
+        with self.client.getting('key') as data:
+            self.assertEqual(data, b'replica')
+        # Locking needs master
+        with self.client.getting('key', lock=True) as data:
+            self.assertEqual(data, b'master')
+
+    @override_settings(CACHEOPS_REPLICA_MAX_LAG=5)
+    def test_max_lag(self):
+        # Test redis is not a replica, so its lag can't be checked
+        with self.client.getting('key') as data:
+            self.assertEqual(data, b'master')
+
+    def test_replica_down(self):
+        self.client.replicas = [CacheopsRedis(port=1)]
+        with self.client.getting('key') as data:
+            self.assertEqual(data, b'master')
+
+    @override_settings(CACHEOPS_REPLICA_MAX_LAG=5)
+    def test_lag_by_offset(self):
+        master_info = {'master_repl_offset': 100}
+        replica_info = {'master_link_status': 'up', 'slave_repl_offset': 100}
+        with mock.patch.object(self.client, 'info', return_value=master_info), \
+                mock.patch.object(self.replica, 'info', return_value=replica_info):
+            with mock.patch('time.time', return_value=100):
+                self.assertTrue(self.client._replica_ok(self.replica))
+            master_info['master_repl_offset'] = 200
+            # Behind master, but has everything it had 5 seconds ago
+            with mock.patch('time.time', return_value=104):
+                self.assertTrue(self.client._replica_ok(self.replica))
+            with mock.patch('time.time', return_value=106):
+                self.assertFalse(self.client._replica_ok(self.replica))
+            replica_info['slave_repl_offset'] = 200
+            with mock.patch('time.time', return_value=108):
+                self.assertTrue(self.client._replica_ok(self.replica))
+
+    def test_master_after_invalidation(self):
+        # Replica could still have data this process just invalidated
+        self.client.forget_local()
+        with self.client.getting('key') as data:
+            self.assertEqual(data, b'master')
+        with mock.patch('time.time', return_value=time.time() + 2):
+            with self.client.getting('key') as data:
+                self.assertEqual(data, b'replica')
+
+
+@override_settings(CACHEOPS_CIRCUIT_BREAKER={'failures': 2, 'reset_timeout': 10})
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.states = []
+
+        def record(sender, state, dropped_invalidations, **kwargs):
+            self.states.append((state, dropped_invalidations))
+        cache_circuit_changed.connect(record, dispatch_uid='circuit', weak=False)
+        self.addCleanup(cache_circuit_changed.disconnect, dispatch_uid='circuit')
+
+    def test_open(self):
+        breaker = CircuitBreaker()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(self.states, [('open', 0)])
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.allow(invalidation=True))
+        self.assertEqual(breaker.dropped_invalidations, 1)
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(self.states, [])
+
+    def test_half_open(self):
+        breaker = CircuitBreaker()
+        with mock.patch('time.time', return_value=100):
+            breaker.failure()
+            breaker.failure()
+            breaker.allow(invalidation=True)
+        with mock.patch('time.time', return_value=110):
+            # Only a single probe goes through
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow(invalidation=True))
+            breaker.failure()
+            self.assertEqual(breaker.state, 'open')
+            self.assertFalse(breaker.allow())
+        with mock.patch('time.time', return_value=120):
+            self.assertTrue(breaker.allow())
+            breaker.success()
+            self.assertTrue(breaker.allow())
+
+        self.assertEqual(self.states, [('open', 0), ('half-open', 0), ('open', 0),
+                                       ('half-open', 0), ('closed', 2)])
+
+    def test_probe_error(self):
+        breaker = CircuitBreaker()
+        call = mock.Mock(side_effect=redis.ResponseError)
+        with mock.patch('cacheops.redis.circuit_breaker', breaker):
+            with mock.patch('time.time', return_value=100):
+                breaker.failure()
+                breaker.failure()
+            with mock.patch('time.time', return_value=110):
+                self.assertRaises(redis.ResponseError, _handle_failure, call)
+                # Not stuck half-open, a new probe goes through
+                self.assertEqual(breaker.state, 'open')
+                call.side_effect = None
+                _handle_failure(call)
+                self.assertEqual(breaker.state, 'closed')
+
+    def test_app_errors(self):
+        breaker = CircuitBreaker()
+        with mock.patch('cacheops.redis.circuit_breaker', breaker):
+            for _ in range(5):
+                self.assertRaises(TypeError, _handle_failure, mock.Mock(side_effect=TypeError))
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_queued_probe(self):
+        breaker = CircuitBreaker()
+        with mock.patch('cacheops.redis.circuit_breaker', breaker), \
+                mock.patch('time.time', return_value=100):
+            breaker.failure()
+            breaker.failure()
+        with mock.patch('cacheops.redis.circuit_breaker', breaker), \
+                mock.patch('time.time', return_value=110):
+            # Queued call doesn't touch redis, so it's no probe
+            with mock.patch.object(script_batch, 'pipelines', {}):
+                _handle_failure(mock.Mock())
+            self.assertEqual(breaker.state, 'open')
+            _handle_failure(mock.Mock())
+            self.assertEqual(breaker.state, 'closed')
+
+    @unittest.skipUnless(settings.CACHEOPS_DEGRADE_ON_FAILURE, 'Only works in degrade mode')
+    def test_skip_calls(self):
+        with mock.patch('cacheops.redis.circuit_breaker', CircuitBreaker()), \
+                mock.patch('redis.StrictRedis.get', side_effect=redis.ConnectionError) as get, \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for _ in range(5):
+                with redis_client.getting('key') as data:
+                    self.assertIsNone(data)
+        self.assertEqual(get.call_count, 2)
+
+    @override_settings(CACHEOPS_CIRCUIT_BREAKER=None)
+    def test_disabled(self):
+        breaker = CircuitBreaker()
+        for _ in range(10):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+
+
+@override_settings(CACHEOPS_POOL={'max_connections': 2, 'timeout': 0.1})
+class PoolTests(TestCase):
+    def setUp(self):
+        self.client = make_client(settings.CACHEOPS_REDIS, CacheopsRedis)
+        self.pool = self.client.connection_pool
+
+    def test_pool(self):
+        self.assertIsInstance(self.pool, CacheopsConnectionPool)
+        self.client.get('foo')
+        self.assertEqual(self.pool.stats(), dict(self.pool.stats(),
+                         created=1, in_use=0, idle=1, waiting=0, acquired=1))
+
+    def test_prewarm(self):
+        self.pool.prewarm(5)
+        stats = self.pool.stats()
+        self.assertEqual((stats['created'], stats['idle']), (2, 2))
+
+    def test_exhausted(self):
+        connections = [self.pool.get_connection('GET') for _ in range(2)]
+        self.assertEqual(self.pool.stats()['in_use'], 2)
+        with self.assertRaises(redis.ConnectionError):
+            self.pool.get_connection('GET')
+        self.assertGreaterEqual(self.pool.stats()['max_acquire_time'], 0.1)
+
+        for connection in connections:
+            self.pool.release(connection)
+        self.client.get('foo')
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+
+def redis_version():
+    return tuple(map(int, redis_client.info()['redis_version'].split('.')))
+
+
+class ScriptTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_preload(self):
+        redis_client.script_flush()
+        preload_scripts()
+        shas = [load_script(name).sha for name in ('cache_thing', 'invalidate', 'lock', 'unlock')]
+        self.assertEqual(redis_client.script_exists(*shas), [True] * 4)
+
+    def _test_recovery(self, invalidate):
+        redis_client.script_flush()
+        category = Category.objects.cache(lock=True).get(pk=1)
+        redis_client.script_flush()
+
+        invalidate(category)
+        with self.assertNumQueries(1):
+            Category.objects.cache().get(pk=1)
+
+    def test_noscript_recovery(self):
+        self._test_recovery(invalidate_obj)
+
+    def test_batch_noscript_recovery(self):
+        def invalidate(obj):
+            with batched_scripts():
+                invalidate_obj(obj)
+        self._test_recovery(invalidate)
+
+    def test_batch_failure_runs_other_pipelines(self):
+        other_client = make_client(settings.CACHEOPS_REDIS, CacheopsRedis)
+        calls = []
+
+        def execute_batch(pipeline):
+            calls.append(pipeline)
+            if len(calls) == 1:
+                raise redis.ResponseError('READONLY')
+            pipeline.execute()
+
+        with mock.patch('cacheops.redis._execute_batch', side_effect=execute_batch):
+            with self.assertRaises(redis.ResponseError):
+                with batched_scripts():
+                    script_batch.pipeline_for(redis_client).set('batch:a', 1)
+                    script_batch.pipeline_for(other_client).set('batch:b', 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(redis_client.exists('batch:a', 'batch:b'), 1)
+
+    @unittest.skipIf(redis_version() < (7,), "Redis functions require redis 7")
+    @override_settings(CACHEOPS_FUNCTIONS=True)
+    def test_functions(self):
+        redis_client.execute_command('FUNCTION', 'FLUSH')
+        self._test_recovery(invalidate_obj)
+
+
+def wait_for(cond, timeout=2):
+    start = time.time()
+    while not cond():
+        if time.time() - start > timeout:
+            raise AssertionError('Timed out waiting')
+        time.sleep(0.01)
+
+
+@override_settings(CACHEOPS_CLIENT_TRACKING={'max_entries': 100})
+class ClientTrackingTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(ClientTrackingTests, self).setUp()
+        self.local_cache = redis_client.local_cache
+        self.local_cache.get('', lambda key: None)
+        wait_for(lambda: self.local_cache.active)
+
+    def _read_locally(self):
+        # Our own cache write is also reported, so first read after it could be not saved
+        wait_for(lambda: Category.objects.cache().get(pk=1) and self.local_cache._data)
+
+    def test_local_hit(self):
+        self._read_locally()
+        self.assertEqual(len(self.local_cache._data), 1)
+
+        with mock.patch.object(CacheopsRedis, 'get') as get:
+            with self.assertNumQueries(0):
+                Category.objects.cache().get(pk=1)
+        self.assertFalse(get.called)
+
+    def test_external_invalidation(self):
+        self._read_locally()
+        # Emulate other process invalidating, local cache learns from redis
+        key, = self.local_cache._data
+        redis_client.delete(key)
+        wait_for(lambda: not self.local_cache._data)
+
+        with self.assertNumQueries(1):
+            Category.objects.cache().get(pk=1)
+
+    def test_own_invalidation(self):
+        self._read_locally()
+        Category.objects.get(pk=1).save()
+
+        with self.assertNumQueries(1):
+            Category.objects.cache().get(pk=1)
+
+    def test_disconnect(self):
+        self._read_locally()
+        redis_client.client_kill_filter(_type='pubsub')
+        wait_for(lambda: not self.local_cache._data)
+
+    def test_dead_connection(self):
+        self._read_locally()
+        # Emulate silently dropped connection, pings get no answer
+        send_command = redis.Connection.send_command
+
+        def drop_ping(conn, *args, **kwargs):
+            if args[0] != 'PING':
+                send_command(conn, *args, **kwargs)
+
+        with mock.patch('cacheops.redis.TRACKING_PING_INTERVAL', 0.05), \
+                mock.patch.object(redis.Connection, 'send_command', drop_ping), \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            wait_for(lambda: not self.local_cache.active, timeout=3)
+        self.assertFalse(self.local_cache._data)
+
+    def test_not_from_replica(self):
+        # Replica reads are not tracked, so these should not get into local cache
+        replica = CacheopsRedis(**dict(settings.CACHEOPS_REDIS, db=14))
+        self.addCleanup(replica.flushdb)
+        replica.set('key', 'replica')
+        redis_client.set('key', 'master')
+        with mock.patch.object(redis_client, 'replicas', [replica]):
+            with redis_client.getting('key') as data:
+                self.assertEqual(data, b'master')
+            with redis_client.getting('key', budget=1) as data:
+                self.assertEqual(data, b'master')
+
+    def test_simple_cache(self):
+        # Simple cache is deleted directly, neither replica nor local cache would know
+        replica = CacheopsRedis(**dict(settings.CACHEOPS_REDIS, db=14))
+        self.addCleanup(replica.flushdb)
+        get_calls = make_inc(cached(timeout=100))
+        with mock.patch.object(redis_client, 'replicas', [replica]):
+            self.assertEqual(get_calls(), 1)
+            replica.set(get_calls.key(), redis_client.get(get_calls.key()))
+            self.assertEqual(get_calls(), 1)
+            get_calls.invalidate()
+            self.assertEqual(get_calls(), 2)
+
+
+@override_settings(CACHEOPS_BACKEND='cacheops.backends.MemoryBackend')
+class MemoryBackendTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_backend(self):
+        self.assertIsInstance(get_backend(), MemoryBackend)
+        redis_client.flushdb()
+        list(Category.objects.cache())
+        self.assertEqual(redis_client.keys('*'), [])
+
+    def test_invalidation(self):
+        Category.objects.cache().get(pk=1)
+        Category.objects.cache().get(pk=2)
+        Category.objects.get(pk=1).save()
+
+        with self.assertNumQueries(1):
+            Category.objects.cache().get(pk=1)
+        with self.assertNumQueries(0):
+            Category.objects.cache().get(pk=2)
+
+    def test_range_and_in(self):
+        list(Measure.objects.cache().filter(value__gt=5))
+        list(Measure.objects.cache().filter(value__in=range(20, 60)))
+
+        Measure.objects.create(value=3)
+        with self.assertNumQueries(0):
+            list(Measure.objects.cache().filter(value__gt=5))
+            list(Measure.objects.cache().filter(value__in=range(20, 60)))
+
+        Measure.objects.create(value=42)
+        with self.assertNumQueries(2):
+            list(Measure.objects.cache().filter(value__gt=5))
+            list(Measure.objects.cache().filter(value__in=range(20, 60)))
+
+    def test_invalidate_model(self):
+        list(Category.objects.cache())
+        invalidate_model(Category)
+        with self.assertNumQueries(1):
+            list(Category.objects.cache())
+
+    def test_simple_cache(self):
+        calls = [0]
+
+        @cached(timeout=60)
+        def get_calls():
+            calls[0] += 1
+            return calls[0]
+
+        self.assertEqual(get_calls(), 1)
+        self.assertEqual(get_calls(), 1)
+
+    def test_lru(self):
+        memory = MemoryBackend(max_entries=2)
+        memory.cache_thing('', 'a', b'1', {'t': [{'id': 1}]}, 60)
+        memory.cache_thing('', 'b', b'2', {'t': [{'id': 2}]}, 60)
+        memory.get('a')
+        memory.cache_thing('', 'c', b'3', {'t': [{'id': 3}]}, 60)
+        self.assertEqual(memory.get_many(['a', 'b', 'c']), [b'1', None, b'3'])
+        # Evicted keys take their invalidators with them
+        self.assertEqual(len(memory._conjs), 2)
+
+        memory.invalidate_dict('', 't', {'id': 3}, {})
+        self.assertEqual(memory.get_many(['a', 'c']), [b'1', None])
+
+
 class NoInvalidationTests(BaseTestCase):
     fixtures = ['basic']
 
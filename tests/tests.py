@@ -1,17 +1,33 @@
 # -*- coding: utf-8 -*-
 from contextlib import contextmanager
+import gc
+import os
 import re
+import gzip
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
+import weakref
 import mock
+import redis
+import six
+from time import sleep
 
 import django
+from django.core.management import call_command
 from django.db import connection
 from django.db import DEFAULT_DB_ALIAS
+from django.conf import settings
 from django.test import override_settings
 from django.test.client import RequestFactory
+from django.http import HttpResponse
+from django.utils.http import parse_http_date
 from django.contrib.auth.models import User
 from django.template import Context, Template
-from django.db.models import F, Count
+from django.db.models import F, Count, Q
 # These were added in Django 2.0
 try:
     from django.db.models import Subquery
@@ -25,6 +41,10 @@ except ImportError:
 from cacheops import invalidate_model, invalidate_obj, \
                      cached, cached_view, cached_as, cached_view_as
 from cacheops import invalidate_fragment
+from cacheops.simple import cache, FileCache, RedisCache, CacheMiss
+from cacheops.utils import func_cache_key, obj_key
+from cacheops.cross import md5hex
+from cacheops.redis import redis_client
 from cacheops.templatetags.cacheops import register
 
 decorator_tag = register.decorator_tag
@@ -262,6 +282,17 @@ class DecoratorTests(BaseTestCase):
         p.save()                               # invalidate by Post
         self.assertEqual(get_calls(1), 3)      # miss and cache
 
+    def test_cached_as_version(self):
+        get_calls = make_inc(cached_as(Category, version=1))
+        same_version = make_inc(cached_as(Category, version=1))
+        new_version = make_inc(cached_as(Category, version=2))
+
+        self.assertEqual(get_calls(), 1)      # cache
+        self.assertEqual(same_version(), 1)   # hit
+        self.assertEqual(same_version.get(), 0)
+        self.assertEqual(new_version(), 1)    # miss
+        self.assertEqual(new_version.get(), 1)
+
     def test_cached_view_as(self):
         get_calls = make_inc(cached_view_as(Category))
 
@@ -276,6 +307,22 @@ class DecoratorTests(BaseTestCase):
         self.assertEqual(get_calls(r2), 1) # hit, since only url is considered
         self.assertEqual(get_calls(r3), 2) # miss
 
+    def test_cached_view_as_conditional(self):
+        calls = [0]
+
+        @cached_view_as(Category, conditional=True)
+        def view(request):
+            calls[0] += 1
+            return HttpResponse('hi %d' % calls[0])
+
+        factory = RequestFactory()
+        etag = view(factory.get('/hi'))['ETag']
+        self.assertEqual(view(factory.get('/hi', HTTP_IF_NONE_MATCH=etag)).status_code, 304)
+
+        Category.objects.create(title='test')  # invalidate
+        response = view(factory.get('/hi', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.content, b'hi 2')
+
     def test_cached_view_on_template_response(self):
         from django.template.response import TemplateResponse
         from django.template import engines
@@ -397,6 +444,29 @@ class TemplateTests(BaseTestCase):
         invalidate_model(Post)
         self.assertRendersTo(t, {'inc': inc, 'qs': qs}, '.2.2.2')
 
+    def test_prefetch_cached(self):
+        inc = make_inc()
+        t = Template("""
+            {% load cacheops %}
+            {% prefetch_cached %}
+                {% cached 60 'a' %}.{{ inc }}{% endcached %}
+                {% cached_as qs 60 'b' %}.{{ inc }}{% endcached_as %}
+                {% for x in xs %}{% cached 60 'c' x %}.{{ inc }}{% endcached %}{% endfor %}
+            {% endprefetch_cached %}
+        """)
+        context = {'inc': inc, 'qs': Post.objects.all(), 'xs': [1, 2]}
+        self.assertRendersTo(t, context, '.1.2.3.4')
+
+        with mock.patch.object(redis_client, 'get', wraps=redis_client.get) as get, \
+                mock.patch.object(redis_client, 'mget', wraps=redis_client.mget) as mget:
+            self.assertRendersTo(t, context, '.1.2.3.4')
+        self.assertEqual(mget.call_count, 1)
+        # Fragments keyed by loop variable are not prefetched
+        self.assertEqual(get.call_count, 2)
+
+        invalidate_model(Post)
+        self.assertRendersTo(t, context, '.1.5.3.4')
+
     def test_decorator_tag(self):
         @decorator_tag
         def my_cached(flag):
@@ -617,6 +687,35 @@ class RelatedTests(BaseTestCase):
             lambda: Post.objects.get(title=title, visible=True).save(),
         )
 
+    def test_reverse_fk_through_join(self):
+        self._template(
+            Category.objects.filter(pk=1, posts__visible=True),
+            lambda: Post.objects.create(category_id=2, title='Other'),
+            should_invalidate=False
+        )
+        self._template(
+            Category.objects.filter(pk=1, posts__visible=True),
+            lambda: Post.objects.create(category_id=1, title='New')
+        )
+
+    def test_isnull_through_outer_join(self):
+        qs = Category.objects.filter(posts__category__isnull=True)
+        self._template(qs, lambda: Category.objects.create(title='New'))
+        self.assertIn('New', [c.title for c in qs.cache()])
+
+    def test_m2m_through_join(self):
+        brand, other = Brand.objects.create(), Brand.objects.create()
+        label = Label.objects.create(text='x')
+        self._template(
+            Brand.objects.filter(pk=brand.pk, labels__text='x'),
+            lambda: other.labels.add(label),
+            should_invalidate=False
+        )
+        self._template(
+            Brand.objects.filter(pk=brand.pk, labels__text='x'),
+            lambda: brand.labels.add(label)
+        )
+
 
 class AggregationTests(BaseTestCase):
     fixtures = ['basic']
@@ -769,6 +868,132 @@ class M2MThroughTests(M2MTests):
         )
 
 
+class LongInTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _template(self, qs, change, should_invalidate=True):
+        list(qs.all().cache())
+        change()
+        with self.assertNumQueries(1 if should_invalidate else 0):
+            list(qs.all().cache())
+
+    def test_granular(self):
+        qs = Category.objects.filter(pk__in=range(100, 150))
+        self._template(qs, lambda: Category.objects.get(pk=1).save(), should_invalidate=False)
+        self._template(qs, lambda: Category.objects.create(pk=120, title='New'))
+
+    def test_with_eq(self):
+        qs = Post.objects.filter(category=1, pk__in=range(100, 150))
+        self._template(qs, lambda: Post.objects.create(pk=120, category_id=2, title='Other'),
+                       should_invalidate=False)
+        self._template(qs, lambda: Post.objects.create(pk=121, category_id=1, title='New'))
+
+    def test_intersect(self):
+        qs = Category.objects.filter(pk__in=range(100, 150)).filter(pk__in=range(140, 190))
+        self._template(qs, lambda: Category.objects.create(pk=120, title='New'),
+                       should_invalidate=False)
+        self._template(qs, lambda: Category.objects.create(pk=145, title='New'))
+
+    def test_strings(self):
+        qs = Category.objects.filter(title__in=['t%d' % i for i in range(20)])
+        self._template(qs, lambda: Category.objects.create(title='t100'), should_invalidate=False)
+        self._template(qs, lambda: Category.objects.create(title='t10'))
+
+    def test_invalidate_model(self):
+        qs = Category.objects.filter(pk__in=range(100, 150))
+        self._template(qs, lambda: invalidate_model(Category))
+
+    def test_values_expire(self):
+        qs = Category.objects.filter(pk__in=range(100, 150))
+        list(qs.cache())
+        values_key, = redis_client.keys(qs._cache_key() + ':in:*')
+        self.assertGreater(redis_client.ttl(values_key), 0)
+
+    def test_prune_index(self):
+        qs = Category.objects.filter(pk__in=range(100, 150))
+        list(qs.cache())
+        # Emulate eviction, next write cleans up after it
+        redis_client.delete(qs._cache_key())
+        Category.objects.get(pk=1).save()
+        self.assertEqual(redis_client.keys('*in:*'), [])
+
+
+class RangeIndexTests(BaseTestCase):
+    def setUp(self):
+        self.m = Measure.objects.create(value=10, taken=datetime(2018, 1, 10), label='a')
+        super(RangeIndexTests, self).setUp()
+
+    def _template(self, qs, change, should_invalidate=True):
+        list(qs.all().cache())
+        change()
+        with self.assertNumQueries(1 if should_invalidate else 0):
+            list(qs.all().cache())
+
+    def test_gt(self):
+        qs = Measure.objects.filter(value__gt=100)
+        self._template(qs, lambda: Measure.objects.create(value=50), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=150))
+
+    def test_lte(self):
+        qs = Measure.objects.filter(value__lte=20)
+        self._template(qs, lambda: Measure.objects.create(value=21), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=20))
+
+    def test_range(self):
+        qs = Measure.objects.filter(value__range=(20, 30))
+        self._template(qs, lambda: Measure.objects.create(value=31), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=19), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=25))
+
+    def test_intersect(self):
+        qs = Measure.objects.filter(value__gte=20).filter(value__lt=30)
+        self._template(qs, lambda: Measure.objects.create(value=35), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=25))
+
+    def test_move_into_range(self):
+        qs = Measure.objects.filter(value__gt=100)
+
+        def change():
+            self.m.value = 200
+            self.m.save()
+        self._template(qs, change)
+
+    def test_move_out_of_range(self):
+        qs = Measure.objects.filter(value__lt=100)
+
+        def change():
+            self.m.value = 200
+            self.m.save()
+        self._template(qs, change)
+
+    def test_datetime(self):
+        qs = Measure.objects.filter(taken__gte=datetime(2018, 2, 1))
+        self._template(qs, lambda: Measure.objects.create(value=1, taken=datetime(2018, 1, 1)),
+                       should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=1, taken=None),
+                       should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=1, taken=datetime(2018, 3, 1)))
+
+    def test_with_eq(self):
+        qs = Measure.objects.filter(label='a', value__gt=100)
+        self._template(qs, lambda: Measure.objects.create(value=150, label='b'),
+                       should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=150, label='a'))
+
+    def test_or(self):
+        qs = Measure.objects.filter(Q(value__lt=0) | Q(value__gt=100))
+        self._template(qs, lambda: Measure.objects.create(value=50), should_invalidate=False)
+        self._template(qs, lambda: Measure.objects.create(value=-5))
+
+    def test_invalidate_model(self):
+        qs = Measure.objects.filter(value__gt=100)
+        self._template(qs, lambda: invalidate_model(Measure))
+
+    def test_not_indexed(self):
+        qs = Measure.objects.filter(pk__gt=100)
+        self._template(qs, lambda: Measure.objects.create(value=50))
+
+
 class ProxyTests(BaseTestCase):
     def test_30(self):
         list(VideoProxy.objects.cache())
@@ -865,6 +1090,166 @@ class SimpleCacheTests(BaseTestCase):
         get_calls.key(2).set(42)
         self.assertEqual(get_calls(2), 42)
 
+    def test_func_cache_key(self):
+        def f():
+            pass
+
+        keys = [func_cache_key(f, args, {}) for args in [(1,), ('1',), (1.0,), (True,), (None,)]]
+        self.assertEqual(len(set(keys)), 5)
+        self.assertEqual(func_cache_key(f, (1,), {}), func_cache_key(f, (1,), {}))
+        self.assertNotEqual(func_cache_key(f, (1,), {}), func_cache_key(f, (), {'x': 1}))
+        self.assertNotEqual(func_cache_key(f, (1,), {}), func_cache_key(make_inc(), (1,), {}))
+
+        cat = Category.objects.create(title='key')
+        self.assertEqual(func_cache_key(f, (cat,), {}), func_cache_key(f, (cat, ), {}))
+        self.assertNotEqual(func_cache_key(f, (cat,), {}), func_cache_key(f, (cat.pk,), {}))
+
+        with override_settings(CACHEOPS_LEGACY_FUNC_KEYS=True):
+            self.assertEqual(func_cache_key(f, (1,), {}),
+                             md5hex(json.dumps([obj_key(f), [1], {}, None])))
+
+    def test_func_cache_key_extra(self):
+        def f():
+            pass
+
+        key = func_cache_key(f, (1,), {}, ['a'])
+        self.assertEqual(key, func_cache_key(f, (1,), {}, ['a']))
+        self.assertNotEqual(key, func_cache_key(f, (1,), {}, ['b']))
+        self.assertNotEqual(key, func_cache_key(f, (1,), {}))
+
+        # Same extra object is only serialized once
+        extra = ['a']
+        func_cache_key(f, (1,), {}, extra)
+        with mock.patch('cacheops.utils.json.dumps') as dumps:
+            self.assertEqual(func_cache_key(f, (1,), {}, extra), key)
+        self.assertFalse(dumps.called)
+
+    def test_func_identity(self):
+        def make_func(code):
+            context = {}
+            exec(code, context)
+            return context['f']
+
+        f = make_func('def f(x):\n    return x + 1')
+        moved = make_func('\n\ndef f(x):\n    return x + 1')
+        changed = make_func('def f(x):\n    return x + 2')
+
+        self.assertNotEqual(obj_key(f), obj_key(moved))
+        with override_settings(CACHEOPS_FUNC_IDENTITY='code'):
+            self.assertEqual(obj_key(f), obj_key(moved))
+            self.assertNotEqual(obj_key(f), obj_key(changed))
+
+        # Defaults are part of identity as well
+        default = make_func('def f(x=1):\n    return x + 1')
+        other_default = make_func('def f(x=2):\n    return x + 1')
+        with override_settings(CACHEOPS_FUNC_IDENTITY='code'):
+            self.assertNotEqual(obj_key(default), obj_key(other_default))
+        # Hashed code is not kept alive
+        code_ref = weakref.ref(default.__code__)
+        del default
+        gc.collect()
+        self.assertIsNone(code_ref())
+
+        cached(version=1)(f)
+        cached(version=1)(changed)
+        self.assertEqual(func_cache_key(f, (1,), {}), func_cache_key(changed, (1,), {}))
+
+    def test_get_set_many(self):
+        cache.set_many({'a': 1, 'b': None}, timeout=100)
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': None})
+
+    def test_get_many_locked(self):
+        cache.set('a', 1, timeout=100)
+        # Someone is calculating this one
+        redis_client.set('b', b'LOCK')
+        self.assertEqual(cache.get_many(['a', 'b']), {'a': 1})
+
+    def test_plain_redis_client(self):
+        plain_cache = RedisCache(redis.StrictRedis(**settings.CACHEOPS_REDIS))
+        calls = []
+
+        @plain_cache.cached(timeout=100, lock=True)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(calls, [2])
+
+        plain_cache.set_many({'a': 1, 'b': None}, timeout=100)
+        self.assertEqual(plain_cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': None})
+
+    def test_map(self):
+        calls = []
+
+        @cached(timeout=100)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square.map([1, 2, 3, 3]), [1, 4, 9, 9])
+        self.assertEqual(calls, [2, 1, 3])
+        self.assertEqual(square.map([(1,), (3,)]), [1, 9])
+        self.assertEqual(calls, [2, 1, 3])
+
+    def test_map_batch(self):
+        @cached(timeout=100)
+        def square(x):
+            raise AssertionError('Batch function should be used')
+
+        @square.many
+        def squares(args_list):
+            return [x * x for x, in args_list]
+
+        self.assertEqual(square.map([1, 2]), [1, 4])
+        self.assertEqual(square(2), 4)
+
+    def test_lock(self):
+        calls = []
+
+        @cached(timeout=100, lock=True)
+        def slow(x):
+            calls.append(x)
+            sleep(0.1)
+            return x
+
+        threads = [threading.Thread(target=slow, args=(1,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(slow(1), 1)
+
+    def test_soft_timeout(self):
+        calls = [0]
+
+        @cached(timeout=100, soft_timeout=0)
+        def get_calls(_):
+            calls[0] += 1
+            return calls[0]
+
+        self.assertEqual(get_calls(1), 1)
+        # Stale result is served while someone else refreshes it
+        with cache.try_lock(get_calls.key(1)) as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(get_calls(1), 1)
+        self.assertEqual(get_calls(1), 2)
+        self.assertEqual(get_calls.map([1, 2]), [3, 4])
+
+    def test_soft_timeout_changed(self):
+        # Same keys for results cached with and without soft timeout, these should not mix up
+        key_func = lambda func, args, kwargs, extra: 'pair:%s' % args
+        plain = cached(timeout=100, key_func=key_func)(lambda x: (x, 'plain'))
+        soft = cached(timeout=100, soft_timeout=100, key_func=key_func)(lambda x: (x, 'soft'))
+        self.assertEqual(plain(1), (1, 'plain'))
+        self.assertEqual(soft(1), (1, 'soft'))
+        self.assertEqual(soft.map([1, 2]), [(1, 'soft'), (2, 'soft')])
+        self.assertEqual(plain(2), (2, 'plain'))
+        self.assertEqual(plain.map([1, 2]), [(1, 'plain'), (2, 'plain')])
+
     def test_cached_view(self):
         calls = [0]
 
@@ -891,6 +1276,213 @@ class SimpleCacheTests(BaseTestCase):
         get_calls.invalidate(r1.build_absolute_uri())
         self.assertEqual(get_calls(r1), 4) # miss
 
+    def test_cached_view_conditional(self):
+        calls = [0]
+
+        @cached_view(timeout=100, conditional=True, vary_headers=['Accept-Language'])
+        def view(request):
+            calls[0] += 1
+            response = HttpResponse('hi %d' % calls[0])
+            response['Cache-Control'] = 'max-age=60'
+            return response
+
+        factory = RequestFactory()
+        response = view(factory.get('/hi'))
+        self.assertEqual(response.content, b'hi 1')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        response = view(factory.get('/hi', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Vary'], 'Accept-Language')
+        self.assertEqual(response['Cache-Control'], 'max-age=60')
+
+        # Could have changed later in the same second
+        modified = parse_http_date(last_modified)
+        with mock.patch('time.time', return_value=modified + 0.5):
+            response = view(factory.get('/hi', HTTP_IF_MODIFIED_SINCE=last_modified))
+            self.assertEqual(response.status_code, 200)
+        with mock.patch('time.time', return_value=modified + 1):
+            response = view(factory.get('/hi', HTTP_IF_MODIFIED_SINCE=last_modified))
+            self.assertEqual(response.status_code, 304)
+        response = view(factory.get('/hi', HTTP_IF_NONE_MATCH='"other"'))
+        self.assertEqual(response.content, b'hi 1')
+
+        view.invalidate(factory.get('/hi'))
+        response = view(factory.get('/hi', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.content, b'hi 2')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_cached_view_vary(self):
+        calls = [0]
+
+        @cached_view(timeout=100, vary_headers=['Accept-Language'], vary_cookies=['theme'])
+        def view(request):
+            calls[0] += 1
+            return HttpResponse(str(calls[0]))
+
+        factory = RequestFactory()
+        self.assertEqual(view(factory.get('/hi', HTTP_ACCEPT_LANGUAGE='en')).content, b'1')
+        self.assertEqual(view(factory.get('/hi', HTTP_ACCEPT_LANGUAGE='en')).content, b'1')
+        self.assertEqual(view(factory.get('/hi', HTTP_ACCEPT_LANGUAGE='de')).content, b'2')
+
+        request = factory.get('/hi', HTTP_ACCEPT_LANGUAGE='en')
+        request.COOKIES['theme'] = 'dark'
+        response = view(request)
+        self.assertEqual(response.content, b'3')
+        self.assertEqual(response['Vary'], 'Accept-Language, Cookie')
+
+    def test_cached_view_gzip(self):
+        calls = [0]
+        content = b'hello ' * 100
+
+        @cached_view(timeout=100, gzip=True)
+        def view(request):
+            calls[0] += 1
+            return HttpResponse(content)
+
+        factory = RequestFactory()
+        response = view(factory.get('/hi'))
+        self.assertEqual(response.content, content)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        response = view(factory.get('/hi', HTTP_ACCEPT_ENCODING='gzip, deflate'))
+        self.assertEqual(calls, [1])
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(response.content)).read(), content)
+
+
+class FileCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = FileCache(self.dir)
+
+    def test_cached(self):
+        calls = [0]
+
+        @self.cache.cached(timeout=100)
+        def get_calls(_):
+            calls[0] += 1
+            return calls[0]
+
+        self.assertEqual(get_calls(1), 1)
+        self.assertEqual(get_calls(1), 1)
+        get_calls.invalidate(1)
+        self.assertEqual(get_calls(1), 2)
+
+    def test_lock(self):
+        calls = []
+
+        @self.cache.cached(timeout=100, lock=True)
+        def slow(x):
+            calls.append(x)
+            sleep(0.1)
+            return x
+
+        threads = [threading.Thread(target=slow, args=(1,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+
+    def test_soft_timeout(self):
+        calls = [0]
+
+        @self.cache.cached(timeout=100, soft_timeout=0)
+        def get_calls(_):
+            calls[0] += 1
+            return calls[0]
+
+        self.assertEqual(get_calls(1), 1)
+        with self.cache.try_lock(get_calls.key(1)) as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(get_calls(1), 1)
+        self.assertEqual(get_calls(1), 2)
+
+    @unittest.skipIf(os.name != 'posix', 'no flock() here')
+    def test_lock_timeout(self):
+        @self.cache.cached(timeout=100, lock=True)
+        def get_one(_):
+            return 1
+
+        with mock.patch('cacheops.simple.LOCK_TIMEOUT', 0.1):
+            with self.cache.try_lock(get_one.key(1)) as acquired:
+                self.assertTrue(acquired)
+                # Gives up waiting for the lock and calculates without it
+                self.assertEqual(get_one(1), 1)
+
+    def test_overwrite(self):
+        self.cache.set('key', 1)
+        self.cache.set('key', 2)
+        self.assertEqual(self.cache.get('key'), 2)
+
+    def test_broken_index(self):
+        cache = FileCache(self.dir, max_size=5000)
+        error = sqlite3.OperationalError('database is locked')
+        with mock.patch('sqlite3.connect', side_effect=error):
+            cache.set('key', 1)
+            self.assertEqual(cache.get('key'), 1)
+            cache.delete('key')
+
+    def test_file_mode(self):
+        # Same as open() would create, not owner only as mkstemp() does
+        umask = os.umask(0)
+        os.umask(umask)
+        self.cache.set('key', 1)
+        filename = self.cache._key_to_filename('key')
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_expired(self):
+        self.cache.set('key', 1, timeout=0)
+        with self.assertRaises(CacheMiss):
+            self.cache.get('key')
+
+    def test_large(self):
+        data = b'x' * (2 * 1024 * 1024)
+        self.cache.set('key', data)
+        self.assertEqual(self.cache.get('key'), data)
+
+    def test_max_size(self):
+        cache = FileCache(self.dir, max_size=5000)
+        for i in range(10):
+            cache.set(str(i), b'x' * 1000)
+            cache.get('0')
+
+        self.assertLessEqual(cache._index.total_size(), 5000)
+        self.assertEqual(cache.get('0'), b'x' * 1000)
+        self.assertRaises(CacheMiss, cache.get, '1')
+        self.assertEqual(cache.get('9'), b'x' * 1000)
+
+    def test_map(self):
+        square = self.cache.cached(timeout=100)(lambda x: x * x)
+        self.assertEqual(square.map([1, 2]), [1, 4])
+        self.assertEqual(self.cache.get_many([square.key(1), square.key(3)]), {square.key(1): 1})
+
+    def test_clean(self):
+        self.cache.set('expired', b'x' * 1000, timeout=0)
+        for i in range(4):
+            self.cache.set(str(i), b'x' * 1000, timeout=100 + i)
+
+        stats = self.cache.clean(max_size=3000, dry_run=True)
+        self.assertEqual(self.cache.get('0'), b'x' * 1000)
+        self.assertEqual(stats, self.cache.clean(max_size=3000))
+        self.assertEqual((stats['expired'], stats['evicted'], stats['files']), (1, 2, 2))
+        self.assertEqual(stats['freed'] + stats['size'], 5 * 1018)
+
+        self.assertRaises(CacheMiss, self.cache.get, '0')
+        self.assertRaises(CacheMiss, self.cache.get, '1')
+        self.assertEqual(self.cache.get('3'), b'x' * 1000)
+
+    def test_clean_command(self):
+        self.cache.set('expired', 1, timeout=0)
+        out = six.StringIO()
+        call_command('cleanfilecache', self.dir, stdout=out)
+        self.assertIn('removed 1 expired', out.getvalue())
+        self.assertEqual(os.listdir(self.dir), [])
+
 
 @unittest.skipIf(connection.settings_dict['ENGINE'] != 'django.contrib.gis.db.backends.postgis',
                  "Only for PostGIS")
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 import unittest
 
+import mock
 import django
+from funcy import count_by, lmap
+from django.conf import settings
 from django.test import override_settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import connections
 
-from .models import Category, Post, Extra
-from .utils import BaseTestCase
+from cacheops import cached_as, cached, invalidate_obj, invalidate_model, invalidate_all
+from cacheops.backends import RedisBackend
+from cacheops.redis import redis_client, shard_client, CacheopsRedis, LuaScript
+from cacheops.simple import cache
+from cacheops.sharding import hash_tagged, same_slot_key, HashRing
+
+from .models import Category, Post, Extra, Measure
+from .utils import BaseTestCase, key_slot
 
 
 class PrefixTests(BaseTestCase):
@@ -51,3 +60,170 @@ class PrefixTests(BaseTestCase):
     def test_union_tables(self):
         qs = Post.objects.filter(pk=1).union(Post.objects.filter(pk=2)).cache()
         list(qs)
+
+
+# NOTE: we use single redis here and check slots with key_slot() simulation
+@override_settings(CACHEOPS_CLUSTER=True, CACHEOPS_CLIENT_CLASS='cacheops.redis.CacheopsRedis')
+class ClusterTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(ClusterTests, self).setUp()
+        self.script_keys = []
+        call = LuaScript.__call__
+
+        def record_call(script, keys=[], *args, **kwargs):
+            self.script_keys.append(keys)
+            return call(script, keys, *args, **kwargs)
+        patcher = mock.patch.object(LuaScript, '__call__', record_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _exercise(self):
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(category__title='Django'))
+        list(Post.objects.cache().filter(pk__in=range(20)))
+        list(Measure.objects.cache().filter(value__gt=10))
+        Category.objects.cache(lock=True).get(pk=2)
+        cached_as(Post)(lambda: 42)()
+
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.save()
+        invalidate_obj(Category.objects.get(pk=1))
+        Measure.objects.create(value=15)
+        invalidate_model(Post)
+
+    def assertSingleSlot(self, keys):
+        slots = set(map(key_slot, keys))
+        self.assertEqual(len(slots), 1, keys)
+
+    def test_scripts_single_slot(self):
+        self._exercise()
+        self.assertTrue(self.script_keys)
+        for keys in self.script_keys:
+            self.assertSingleSlot(keys)
+
+    def test_simple_cache_locks(self):
+        func = cached(timeout=100, lock=True)(lambda: 42)
+        func()
+        for keys in self.script_keys:
+            self.assertSingleSlot(keys)
+        with cache.try_lock(func.key()):
+            self.assertSingleSlot(redis_client.keys('*'))
+
+    def _patch_mget(self):
+        # Keys are not in a single slot, so cluster client can only fetch them non-atomically
+        return mock.patch.multiple(
+            CacheopsRedis, create=True,
+            mget=mock.Mock(side_effect=AssertionError('Cross slot')),
+            mget_nonatomic=mock.Mock(side_effect=lambda keys: lmap(redis_client.get, keys)))
+
+    def test_get_many(self):
+        redis_client.set('a', b'1')
+        with self._patch_mget():
+            self.assertEqual(RedisBackend().get_many(['a', 'b']), [b'1', None])
+
+    def test_prefetching(self):
+        redis_client.set('a', b'1')
+        backend = RedisBackend()
+        with self._patch_mget(), backend.prefetching([(None, 'a'), (None, 'b')]):
+            with mock.patch.object(CacheopsRedis, 'get') as get:
+                with backend.getting(None, 'a') as data:
+                    self.assertEqual(data, b'1')
+            self.assertFalse(get.called)
+
+    def test_keys_single_slot(self):
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(category__title='Django'))
+        list(Post.objects.cache().filter(pk__in=range(20)))
+        list(Measure.objects.cache().filter(value__gt=10))
+        self.assertSingleSlot(redis_client.keys('*'))
+
+    @override_settings(CACHEOPS_PREFIX=lambda q: q.table)
+    def test_prefix_spreads_slots(self):
+        self.assertTrue(Category.objects.all()._cache_key().startswith('{tests_category}'))
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(pk=1))
+        self.assertEqual(len(set(map(key_slot, redis_client.keys('*')))), 2)
+
+        # Invalidation still works with keys spread
+        invalidate_obj(Post.objects.get(pk=1))
+        with self.assertNumQueries(0):
+            list(Category.objects.cache().filter(pk=1))
+        invalidate_obj(Category.objects.get(pk=1))
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(pk=1))
+
+    def test_hash_tagged(self):
+        self.assertEqual(hash_tagged(''), '{cacheops}')
+        self.assertEqual(hash_tagged('site:'), '{site:}')
+        self.assertEqual(hash_tagged('site:{1}:'), 'site:{1}:')
+        with self.assertRaises(ImproperlyConfigured):
+            hash_tagged('site:{}:')
+        with self.assertRaises(ImproperlyConfigured):
+            hash_tagged('site:}')
+
+    def test_same_slot_key(self):
+        for key in ['c:1', '{site}q:1', 'q:{1}']:
+            self.assertEqual(key_slot(same_slot_key(key, ':lock')), key_slot(key))
+
+
+SHARDS = {
+    'a': dict(settings.CACHEOPS_REDIS, db=14),
+    'b': dict(settings.CACHEOPS_REDIS, db=15),
+}
+
+@override_settings(CACHEOPS_SHARDS=SHARDS, CACHEOPS_PREFIX=lambda q: q.table)
+class ShardsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_routing(self):
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(pk=1))
+
+        for table in ['tests_category', 'tests_post']:
+            client = shard_client(table)
+            self.assertTrue(client.keys(table + 'q:*'))
+            for other in {shard_client('tests_category'), shard_client('tests_post'), redis_client}:
+                if other is not client:
+                    self.assertFalse(other.keys(table + '*'))
+
+    def test_invalidation(self):
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(pk=1))
+
+        invalidate_obj(Post.objects.get(pk=1))
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(pk=1))
+            list(Post.objects.cache().filter(pk=1))
+
+        invalidate_model(Category)
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(pk=1))
+            list(Post.objects.cache().filter(pk=1))
+
+    def test_invalidate_all(self):
+        list(Category.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(pk=1))
+        invalidate_all()
+        with self.assertNumQueries(2):
+            list(Category.objects.cache().filter(pk=1))
+            list(Post.objects.cache().filter(pk=1))
+
+
+class HashRingTests(unittest.TestCase):
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = count_by(ring.get, map(str, range(3000)))
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        self.assertTrue(all(700 < n < 1300 for n in counts.values()), counts)
+
+    def test_stable(self):
+        keys = lmap(str, range(1000))
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        # Only keys moved to a new node change
+        self.assertTrue(all(after.get(key) == 'd' for key in moved))
+        self.assertTrue(len(moved) < 400)
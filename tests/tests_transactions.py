@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
+import re
 import unittest
 
 from django.db import connection
 from django.db.transaction import atomic
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from cacheops.transaction import queue_when_in_transaction
+from cacheops.signals import cache_invalidated
+from cacheops.transaction import queue_when_in_transaction, classify_sql, CLEAN, UNKNOWN
 
-from .models import Category
+from .models import Category, Post, Media, Movie
 from .utils import run_in_thread
 
 
@@ -15,6 +18,55 @@ def get_category():
     return Category.objects.cache().get(pk=1)
 
 
+SQL_CORPUS = [
+    ('SELECT "tests_category"."id" FROM "tests_category" WHERE "tests_category"."id" = %s', CLEAN),
+    ('  select * from tests_post where title = \'update\'', CLEAN),
+    ('SELECT "tests_post"."id" FROM "tests_post" FOR UPDATE', UNKNOWN),
+    ('SELECT "tests_post"."id" FROM "tests_post" FOR NO KEY UPDATE NOWAIT', UNKNOWN),
+    ('SELECT "tests_post"."id" FROM "tests_post" WHERE "id" IN (%s, %s) FOR UPDATE SKIP LOCKED',
+        UNKNOWN),
+    ('SAVEPOINT "s1_x1"', CLEAN),
+    ('RELEASE SAVEPOINT "s1_x1"', CLEAN),
+    ('ROLLBACK TO SAVEPOINT "s1_x1"', CLEAN),
+    ('SET CONSTRAINTS ALL IMMEDIATE', CLEAN),
+    ('INSERT INTO "tests_post" ("title", "category_id") VALUES (%s, %s)',
+        (True, {'tests_post'})),
+    ('INSERT INTO "tests_post" ("title") VALUES (%s), (%s), (%s) RETURNING "tests_post"."id"',
+        (True, {'tests_post'})),
+    ('INSERT INTO "tests_post" ("title") SELECT %s UNION ALL SELECT %s', (True, {'tests_post'})),
+    ('INSERT OR REPLACE INTO "tests_post" VALUES (1)', (True, {'tests_post'})),
+    ('insert ignore into `tests_post` (`title`) values (%s)', (True, {'tests_post'})),
+    ('REPLACE INTO `tests_post` (`title`) VALUES (%s)', (True, {'tests_post'})),
+    ('INSERT INTO tests_post(title) VALUES (%s)', (True, {'tests_post'})),
+    ('UPDATE `tests_post` SET `title` = %s', (True, {'tests_post'})),
+    ('UPDATE "tests_post" SET "title" = %s WHERE "tests_post"."id" IN '
+     '(SELECT U0."id" FROM "tests_category" U0)', (True, {'tests_post'})),
+    ('delete from tests_post where id in (select 1)', (True, {'tests_post'})),
+    ('DELETE FROM "tests_post" WHERE "tests_post"."id" IN (%s);', (True, {'tests_post'})),
+    ('UPDATE "public"."tests_post" SET title = 1', UNKNOWN),
+    ('UPDATE ONLY tests_post SET title = 1', UNKNOWN),
+    ('UPDATE a, b SET a.x = b.x', UNKNOWN),
+    ('UPDATE a , b SET b.x = a.x', UNKNOWN),
+    ('UPDATE `a` JOIN `b` ON a.id = b.a_id SET b.x = 1', UNKNOWN),
+    ('UPDATE a INNER JOIN b USING (id) SET b.x = 1', UNKNOWN),
+    ('DELETE t FROM tests_post t', UNKNOWN),
+    ('UPDATE a SET x = 1; UPDATE b SET x = 1', UNKNOWN),
+    ('select 1; delete from t', UNKNOWN),
+    ('SET x = 1; UPDATE t SET x = 1', UNKNOWN),
+    ('SELECT 1; SELECT 2', CLEAN),
+    ('SELECT "tests_post"."id" FROM "tests_post" FOR UPDATE OF %s SKIP LOCKED'
+        % ', '.join('"t%d"' % i for i in range(100)), UNKNOWN),
+    ('WITH t AS (SELECT 1) UPDATE tests_post SET visible = 1', UNKNOWN),
+    ('WITH t AS (SELECT 1) SELECT * FROM t', CLEAN),
+    ('EXPLAIN SELECT updated FROM tests_post', CLEAN),
+    ('(SELECT 1) UNION (SELECT 2)', CLEAN),
+    ('/* comment */ DELETE FROM tests_post', UNKNOWN),
+    ('CALL do_something()', CLEAN),
+    ('', CLEAN),
+    (b'UPDATE tests_post SET title = 1', (True, {'tests_post'})),
+]
+
+
 class IntentionalRollback(Exception):
     pass
 
@@ -93,6 +145,126 @@ class TransactionSupportTests(TransactionTestCase):
             with self.assertNumQueries(1):
                 get_category()
 
+    def test_dirty_tables(self):
+        def get_posts():
+            return list(Post.objects.cache().filter(category=1))
+
+        def get_joined():
+            return list(Category.objects.cache().filter(posts__title='Cacheops'))
+
+        def get_subquery():
+            return list(Category.objects.cache().filter(pk__in=Post.objects.values('category')))
+
+        with atomic():
+            get_category()
+            Post.objects.filter(pk=1).update(title='Changed')
+
+            # Category table is not written, so it's still cached
+            with self.assertNumQueries(0):
+                get_category()
+
+            for get in [get_posts, get_joined, get_subquery]:
+                get()
+                with self.assertNumQueries(1):
+                    get()
+
+    def test_dirty_tables_joined_on_compile(self):
+        Movie.objects.create(name='Matrix', year=1999)
+
+        def get_selected():
+            return list(Post.objects.cache().select_related('category'))
+
+        def get_child():
+            return list(Movie.objects.cache().filter(year=1999))
+
+        with atomic():
+            Category.objects.filter(pk=1).update(title='Changed')
+            Media.objects.update(name='Changed')
+
+            for get in [get_selected, get_child]:
+                get()
+                with self.assertNumQueries(1):
+                    get()
+
+    def test_dirty_tables_case(self):
+        def get_posts():
+            return list(Post.objects.cache().filter(category=1))
+
+        with atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('UPDATE TESTS_POST SET visible = %s', [False])
+            get_posts()
+            with self.assertNumQueries(1):
+                get_posts()
+
+    def test_dirty_tables_raw(self):
+        with atomic():
+            get_category()
+            with connection.cursor() as cursor:
+                cursor.execute('UPDATE tests_post SET visible = %s', [False])
+            with self.assertNumQueries(0):
+                get_category()
+
+            # Can't tell written table here, so everything is dirty
+            with connection.cursor() as cursor:
+                cursor.execute('WITH t AS (SELECT 1) UPDATE tests_post SET visible = %s', [True])
+            with self.assertNumQueries(1):
+                get_category()
+
+    @override_settings(CACHEOPS_TRANSACTION_CACHE=True)
+    def test_transaction_cache(self):
+        with atomic():
+            obj = get_category()
+            obj.title = 'Changed'
+            obj.save()
+            with self.assertNumQueries(1):
+                get_category()
+            with self.assertNumQueries(0):
+                self.assertEqual(get_category().title, 'Changed')
+
+            # Writes to a table forget reads from it
+            Category.objects.filter(pk=1).update(title='Again')
+            with self.assertNumQueries(1):
+                self.assertEqual(get_category().title, 'Again')
+
+            # Reads within rolled back savepoint are discarded
+            try:
+                with atomic():
+                    Category.objects.filter(pk=1).update(title='Rolled back')
+                    self.assertEqual(get_category().title, 'Rolled back')
+                    raise IntentionalRollback()
+            except IntentionalRollback:
+                pass
+            with self.assertNumQueries(1):
+                self.assertEqual(get_category().title, 'Again')
+            self.assertEqual('Django', run_in_thread(get_category).title)
+        self.assertEqual('Again', get_category().title)
+
+    def test_classify_sql(self):
+        for sql, expected in SQL_CORPUS:
+            self.assertEqual(classify_sql(sql), expected, sql)
+
+    def test_classify_orm_sql(self):
+        with CaptureQueriesContext(connection) as queries:
+            with atomic():
+                list(Category.objects.filter(title__in=['update', 'insert']))
+                Category.objects.count()
+                post = Post.objects.create(title='New', category_id=1)
+                Post.objects.filter(pk=post.pk).update(title='Changed')
+                Post.objects.bulk_create([Post(title='Bulk', category_id=1)] * 3)
+                Category.objects.filter(pk=4).delete()
+
+        written = set()
+        for sql in (q['sql'] for q in queries.captured_queries):
+            dirty, tables = classify_sql(sql)
+            if sql.startswith(('INSERT', 'UPDATE', 'DELETE')):
+                # Table is the first quoted name in ORM generated sql
+                self.assertEqual(tables, {re.search(r'"(\w+)"', sql).group(1)}, sql)
+                written |= tables
+            else:
+                self.assertEqual((dirty, tables), CLEAN, sql)
+        self.assertTrue({'tests_post', 'tests_category'} <= written)
+
     @unittest.skipIf(not hasattr(connection, 'on_commit'),
                      'No on commit hooks support (Django < 1.9)')
     def test_call_cacheops_cbs_before_on_commit_cbs(self):
@@ -110,6 +282,27 @@ class TransactionSupportTests(TransactionTestCase):
 
         self.assertEqual(calls, ['cacheops', 'django'])
 
+    def test_dedup_invalidations(self):
+        calls = []
+
+        def set_signal(signal=None, **kwargs):
+            calls.append(kwargs)
+        cache_invalidated.connect(set_signal, dispatch_uid='dedup', weak=False)
+
+        try:
+            with atomic():
+                obj = get_category()
+                for _ in range(5):
+                    obj.save()
+                with atomic():
+                    obj.save()
+                self.assertEqual(calls, [])
+        finally:
+            cache_invalidated.disconnect(dispatch_uid='dedup')
+
+        # Old and new versions of object are the same and thus invalidated once
+        self.assertEqual(len(calls), 1)
+
     def test_multidb(self):
         try:
             with atomic('slave'):
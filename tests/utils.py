@@ -69,3 +69,24 @@ def run_in_thread(target):
     t = ThreadWithReturnValue(target=target)
     t.start()
     return t.join()
+
+
+# Redis cluster slot simulation
+def _crc16(data):
+    # CRC16-XMODEM as used by redis cluster
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+def key_slot(key):
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return _crc16(key) % 16384